@@ -0,0 +1,72 @@
+"""
+Throughput of concurrent generation requests with a tiny hf model on the cpu: every request generated alone
+(one generate call at a time, like the generation lock) against the GenerationScheduler batching them.
+
+python -m benchmarks.bench_batching [model] [request_count] [max_batch_size]
+"""
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from chatbot.model.generation_scheduler import GenerationScheduler, generate_batch
+
+PROMPTS = [
+    "User: Hello, how are you today?\nAssistant:",
+    "User: What did you do yesterday evening?\nAssistant:",
+    "Summarize the following conversation. User: I was thinking about the weather and my cat.",
+    "User: Tell me something about yourself.\nAssistant:",
+]
+STOP_WORDS = ["User:", "\n"]
+MAX_TOKENS = [32, 48, 64]
+
+
+def run(submit, request_count: int, clients: int) -> float:
+    """
+    Send request_count requests from several client threads.
+    :return: elapsed seconds
+    """
+    def client(i):
+        return submit(PROMPTS[i % len(PROMPTS)], MAX_TOKENS[i % len(MAX_TOKENS)], STOP_WORDS)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(client, range(request_count)))
+    return time.perf_counter() - start
+
+
+def main(args) -> None:
+    model_path = args[0] if len(args) > 0 else "sshleifer/tiny-gpt2"
+    request_count = int(args[1]) if len(args) > 1 else 64
+    max_batch_size = int(args[2]) if len(args) > 2 else 8
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModelForCausalLM.from_pretrained(model_path).to("cpu")
+    model.eval()
+
+    def generate(prompts, max_token_lengths, stop_words):
+        return generate_batch(model, tokenizer, "cpu", prompts, max_token_lengths, stop_words,
+                              do_sample=True, temperature=0.9, repetition_penalty=1.1)
+
+    lock = threading.Lock()
+
+    def submit_single(prompt, max_token_length, stop_words):
+        with lock:
+            return generate([prompt], [max_token_length], [stop_words])[0]
+
+    scheduler = GenerationScheduler(generate, max_batch_size=max_batch_size, batch_wait=0.02)
+
+    def submit_batched(prompt, max_token_length, stop_words):
+        return scheduler.submit(prompt, max_token_length, stop_words).result()
+
+    run(submit_single, len(PROMPTS), 1)
+    print(f"{model_path}, {request_count} requests from {max_batch_size} clients")
+    for label, submit in [("one at a time", submit_single), (f"batched (max {max_batch_size})", submit_batched)]:
+        elapsed = run(submit, request_count, max_batch_size)
+        print(f"  {label:<20} {request_count / elapsed:>8.2f} requests/s  ({elapsed:.2f}s)")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,82 @@
+"""
+Compare the embedder backends on stored messages: throughput of the PyTorch, ONNX and int8 ONNX embedder and
+parity of the ONNX embeddings with the PyTorch embeddings (cosine similarity per message).
+Exits with status 1 if a backend drifts further than its threshold.
+
+python -m benchmarks.bench_embedder config.json [message_count]
+"""
+import sys
+import time
+import random
+import sqlite3
+
+import numpy as np
+
+from chatbot.config import get_config
+from chatbot.global_state import GlobalState
+from chatbot.chroma_manager import create_embedder
+from chatbot.embedding_index import normalize_rows
+
+# min cosine similarity to the pytorch embedding per backend
+PARITY_THRESHOLDS = {
+    "onnx": 0.999,
+    "onnx int8": 0.97,
+}
+
+WORDS = ["hello", "how", "are", "you", "today", "I", "was", "thinking", "about", "the", "weather", "and", "my", "cat"]
+
+
+def load_messages(path: str, count: int) -> [str]:
+    """
+    Newest messages of the database, random sentences if there are none.
+    """
+    try:
+        con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        res = con.execute("select message from messages where message is not null order by id desc limit ?",
+                          (count,)).fetchall()
+        con.close()
+    except sqlite3.Error:
+        res = []
+
+    if len(res) == 0:
+        print(f"No messages in {path}, using random sentences")
+        return [" ".join(random.choice(WORDS) for i in range(random.randint(5, 40))) for j in range(count)]
+    return [row[0] for row in res]
+
+
+def bench(label: str, embedder, texts: [str], batch_size: int) -> np.ndarray:
+    embedder.encode(texts[:batch_size], batch_size=batch_size)
+    start = time.perf_counter()
+    embeddings = np.asarray(embedder.encode(texts, batch_size=batch_size), dtype=np.float32)
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<24} {len(texts) / elapsed:>10.1f} texts/s  ({elapsed:.3f}s)")
+    return embeddings
+
+
+def main(args) -> int:
+    gs = GlobalState()
+    gs.config = get_config(args[0])
+    count = int(args[1]) if len(args) > 1 else 1000
+    batch_size = gs.config["embedding_batch_size"]
+
+    texts = load_messages(gs.config["database_path"], count)
+    print(f"{len(texts)} texts, batch size {batch_size}, embedder {gs.config['chromadb_embedder']}")
+
+    reference = bench("sentence_transformers", create_embedder("sentence_transformers"), texts, batch_size)
+
+    failed = False
+    for label, quantize in [("onnx", False), ("onnx int8", True)]:
+        gs.config["embedder_onnx_quantize"] = quantize
+        embeddings = bench(label, create_embedder("onnx"), texts, batch_size)
+
+        sims = np.sum(normalize_rows(reference) * normalize_rows(embeddings), axis=1)
+        ok = sims.min() >= PARITY_THRESHOLDS[label]
+        failed = failed or not ok
+        print(f"  {'':<24} cosine to pytorch: min {sims.min():.5f}, mean {sims.mean():.5f}  "
+              f"{'ok' if ok else 'FAILED'}")
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,109 @@
+"""
+Compare insert/commit throughput of the default sqlite settings against the tuned connection profile
+on a synthetic database.
+
+python -m benchmarks.bench_sqlite_profile [message_count]
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+from datetime import datetime, timezone
+
+from chatbot.db_manager import DB_SCHEMA, MIGRATIONS, apply_connection_profile
+
+DEFAULT_PROFILE = {
+    "sqlite_journal_mode": "delete",
+    "sqlite_synchronous": "full",
+    "sqlite_mmap_size": 0,
+    "sqlite_cache_size": -2000,
+    "sqlite_temp_store": "default",
+}
+
+TUNED_PROFILE = {
+    "sqlite_journal_mode": "wal",
+    "sqlite_synchronous": "normal",
+    "sqlite_mmap_size": 268435456,
+    "sqlite_cache_size": -65536,
+    "sqlite_temp_store": "memory",
+}
+
+WORDS = ["hello", "how", "are", "you", "today", "I", "was", "thinking", "about", "the", "weather", "and", "my", "cat"]
+
+
+def random_message() -> str:
+    return " ".join(random.choice(WORDS) for i in range(random.randint(5, 40)))
+
+
+def create_database(path: str, profile: dict, message_count: int) -> sqlite3.Connection:
+    con = sqlite3.connect(path)
+    con.row_factory = sqlite3.Row
+    con.executescript(DB_SCHEMA)
+    for target, migration in MIGRATIONS:
+        migration(con.cursor())
+    con.commit()
+    apply_connection_profile(con, profile)
+
+    now = datetime.now(timezone.utc)
+    rows = [(1 + i % 4, i % 2, "User", random_message(), now, 30) for i in range(message_count)]
+    con.executemany("insert into messages (character_id, is_user, character, message, time, token_count) "
+                    "values (?, ?, ?, ?, ?, ?)", rows)
+    con.commit()
+    return con
+
+
+def bench(name: str, fn, count: int) -> None:
+    start = time.perf_counter()
+    fn(count)
+    elapsed = time.perf_counter() - start
+    print(f"  {name:<32} {count / elapsed:>12.0f} ops/s  ({elapsed:.3f}s)")
+
+
+def run_profile(label: str, profile: dict, message_count: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        start = time.perf_counter()
+        con = create_database(path, profile, message_count)
+        print(f"{label}: created {message_count} messages in {time.perf_counter() - start:.2f}s")
+
+        now = datetime.now(timezone.utc)
+
+        def insert_commit_each(count):
+            for i in range(count):
+                con.execute("insert into messages (character_id, is_user, character, message, time, token_count) "
+                            "values (?, ?, ?, ?, ?, ?)", (1, 1, "User", random_message(), now, 30))
+                con.commit()
+
+        def insert_one_transaction(count):
+            for i in range(count):
+                con.execute("insert into messages (character_id, is_user, character, message, time, token_count) "
+                            "values (?, ?, ?, ?, ?, ?)", (1, 1, "User", random_message(), now, 30))
+            con.commit()
+
+        def update_commit_each(count):
+            for i in range(count):
+                con.execute("update messages set nsfw_ratio = ? where id = ?", (random.random(), i + 1))
+                con.commit()
+
+        def read_window(count):
+            for i in range(count):
+                con.execute("select id, character, message, token_count from messages where character_id = ? "
+                            "order by id desc limit 64", (1 + i % 4,)).fetchall()
+
+        bench("insert + commit per row", insert_commit_each, 1000)
+        bench("insert, one commit", insert_one_transaction, 10000)
+        bench("update + commit per row", update_commit_each, 1000)
+        bench("read prompt window", read_window, 2000)
+        con.close()
+
+
+def main(args) -> None:
+    message_count = int(args[0]) if len(args) > 0 else 100000
+    run_profile("default", DEFAULT_PROFILE, message_count)
+    run_profile("tuned", TUNED_PROFILE, message_count)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,70 @@
+"""
+Compare the cost of stop string detection per generation: decoding the whole output every step against the
+incremental StopStringDetector, for 256 to 2048 generated tokens and batches of 1 and 4 sequences.
+No model is needed, the generated tokens are random ids of the tokenizer.
+
+python -m benchmarks.bench_stop_strings [tokenizer]
+"""
+import sys
+import time
+
+import torch
+from transformers import AutoTokenizer
+
+from chatbot.model_utils import StopStringDetector
+
+STOP_STRINGS = ["User:", "\n"]
+PROMPT_LENGTH = 512
+LENGTHS = [256, 512, 1024, 2048]
+BATCH_SIZES = [1, 4]
+
+
+def full_decode(tokenizer, input_ids, prompt_length: int) -> [bool]:
+    """
+    Previous implementation: decode the whole output of every sequence and search all stop strings.
+    """
+    result = []
+    for ids in input_ids:
+        output = tokenizer.decode(ids[prompt_length:])
+        result.append(any(stop in output for stop in STOP_STRINGS))
+    return result
+
+
+def random_ids(tokenizer, batch_size: int, length: int) -> torch.LongTensor:
+    """
+    Random token ids that never decode to a stop string, so every run goes through all steps.
+    """
+    banned = set()
+    for id in range(tokenizer.vocab_size):
+        text = tokenizer.decode([id])
+        if any(c in text for c in "\n:"):
+            banned.add(id)
+    allowed = torch.tensor([id for id in range(tokenizer.vocab_size) if id not in banned])
+    return allowed[torch.randint(len(allowed), (batch_size, length))]
+
+
+def bench(fn, input_ids, prompt_length: int) -> float:
+    start = time.perf_counter()
+    for step in range(prompt_length + 1, input_ids.shape[1] + 1):
+        fn(input_ids[:, :step])
+    return time.perf_counter() - start
+
+
+def main(args) -> None:
+    tokenizer = AutoTokenizer.from_pretrained(args[0] if len(args) > 0 else "gpt2")
+
+    for batch_size in BATCH_SIZES:
+        input_ids = random_ids(tokenizer, batch_size, PROMPT_LENGTH + max(LENGTHS))
+        for length in LENGTHS:
+            ids = input_ids[:, :PROMPT_LENGTH + length]
+
+            full = bench(lambda x: full_decode(tokenizer, x, PROMPT_LENGTH), ids, PROMPT_LENGTH)
+            detector = StopStringDetector(tokenizer, STOP_STRINGS, PROMPT_LENGTH)
+            incremental = bench(detector.update, ids, PROMPT_LENGTH)
+
+            print(f"batch {batch_size}, {length:>5} tokens: full decode {full * 1000:>9.1f} ms, "
+                  f"incremental {incremental * 1000:>8.1f} ms, {full / incremental:>6.1f}x")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,4 +3,4 @@ import sys
 from chatbot.main import main
 
 if __name__ == '__main__':
-    main(sys.argv)
\ No newline at end of file
+    main(sys.argv[1:])
\ No newline at end of file
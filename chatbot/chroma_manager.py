@@ -1,13 +1,23 @@
 import chromadb
-from sentence_transformers import SentenceTransformer
 import sqlite3
+import os
+import time
+import logging
+import hashlib
+import threading
 from collections import OrderedDict
+from typing import Optional
 
 from scipy.signal import savgol_filter
 import numpy as np
 
 from chatbot.global_state import GlobalState
 from chatbot.utils import np_to_blob, blob_to_np, cosine_sim, l2_squared
+from chatbot.embedding_index import EmbeddingIndex
+from chatbot.embedding_sidecar import EmbeddingSidecar
+from chatbot.embedder import EmbedderBase
+
+logger = logging.getLogger('chroma_manager')
 
 class ChromaManager:
     def __init__(self):
@@ -16,6 +26,11 @@ class ChromaManager:
         self.col_messages = None
         self.col_summaries = None
         self.model = None
+        self.embedder_id = None
+        self.indices = {}
+        self.sidecars = {}
+        self.query_cache = OrderedDict()
+        self.query_cache_lock = threading.Lock()
 
         self.initialize_chroma()
 
@@ -29,8 +44,8 @@ class ChromaManager:
         embedder = self.gs.config["chromadb_embedder"]
 
         if embedder != "":
-            chromadb_embedder = SentenceTransformer(embedder)
-            self.model = chromadb_embedder
+            self.model = create_embedder(self.gs.config["embedder_backend"])
+            self.embedder_id = self.model.get_embedder_id()
 
     def insert(self, is_message: bool, id: int, character_id: int, is_user: bool, text: str, token_count: int) -> None:
         if is_message:
@@ -51,9 +66,14 @@ class ChromaManager:
         else:
             collection = self.col_summaries
 
-        collection.delete(
-            ids=[f"{id}"]
-        )
+        for (index_is_message, character_id), index in self.indices.items():
+            if index_is_message == is_message:
+                index.remove(id)
+
+        if collection is not None:
+            collection.delete(
+                ids=[f"{id}"]
+            )
 
     def clear(self, is_message: bool) -> None:
         if is_message:
@@ -98,95 +118,387 @@ class ChromaManager:
 
 
     def calc_embeddings_messages(self, id):
-        con = self.gs.db_manager.con
+        if id is None:
+            self.backfill_embeddings("messages", "message")
+            return
+
         cur = self.gs.db_manager.cur
+        res = cur.execute("select id, character_id, token_count, message from messages where id = ?", (id,)).fetchall()
+        for r in res:
+            embeddings = self.model.encode(r["message"])
+            self.store_embedding("messages", r["character_id"], id, embeddings)
+            self.update_index(True, r["character_id"], id, r["token_count"], embeddings)
+        self.gs.db_manager.commit()
 
+    def calc_embeddings_summaries(self, id):
         if id is None:
-            sql = "select * from messages"
-        else:
-            sql = f"select * from messages where id = {id}"
-        res = cur.execute(sql)
-        res = res.fetchall()
+            self.backfill_embeddings("summaries", "summary")
+            return
+
+        cur = self.gs.db_manager.cur
+        res = cur.execute("select id, character_id, token_count, summary from summaries where id = ?", (id,)).fetchall()
         for r in res:
-            id = r["id"]
-            msg = r["message"]
+            embeddings = self.model.encode(r["summary"])
+            self.store_embedding("summaries", r["character_id"], id, embeddings)
+            self.update_index(False, r["character_id"], id, r["token_count"], embeddings)
+        self.gs.db_manager.commit()
 
-            embeddings = self.model.encode(msg)
-            blob = np_to_blob(embeddings)
+    def backfill_embeddings(self, table: str, text_column: str) -> None:
+        """
+        Embed all rows of a table that have no embedding or one from another embedder.
+        Rows are streamed in chunks, every chunk is encoded with one encode call and written in one transaction.
+        The database is only locked for reading and writing, not while encoding.
+        :param table: messages or summaries
+        :param text_column: column with the text to embed
+        """
+        db_manager = self.gs.db_manager
+        batch_size = self.gs.config["embedding_batch_size"]
+        embedder = self.embedder_id
+
+        stale = "((embedding is null and embedding_offset is null) or embedding_model is null or embedding_model != ?)"
+        with db_manager.lock:
+            total = db_manager.con.execute(f"select count(*) as cnt from {table} where {stale}",
+                                           (embedder,)).fetchone()["cnt"]
+        done = 0
+        last_id = -1
+        start = time.time()
+        while True:
+            sql = f"select id, character_id, {text_column} from {table} where id > ? and {stale} order by id asc limit ?"
+            with db_manager.lock:
+                res = db_manager.con.execute(sql, (last_id, embedder, batch_size)).fetchall()
+            if len(res) == 0:
+                break
 
-            sql = "update messages set embedding = ? where id = ?"
-            cur.execute(sql, (sqlite3.Binary(blob), id))
-        con.commit()
+            texts = [row[text_column] or "" for row in res]
+            embeddings = self.model.encode(texts, batch_size=batch_size)
+            with db_manager.transaction():
+                self.store_embeddings(table, [row["character_id"] for row in res], [row["id"] for row in res],
+                                      embeddings)
 
-    def calc_embeddings_summaries(self, id):
-        con = self.gs.db_manager.con
-        cur = self.gs.db_manager.cur
+            last_id = res[-1]["id"]
+            done += len(res)
+            elapsed = max(time.time() - start, 1e-6)
+            logger.info(f"Embeddings {table}: {done}/{total} rows, {done / elapsed:.1f} rows/s")
 
-        if id is None:
-            sql = "select * from summaries"
+        self.invalidate_index(is_message=(table == "messages"))
+
+    def start_lazy_reembed(self) -> None:
+        """
+        Start the background thread that upgrades embeddings of other embedders, if enabled.
+        """
+        if self.gs.config["lazy_reembed"] and self.model is not None:
+            thread = threading.Thread(target=self.lazy_reembed, name="lazy_reembed", daemon=True)
+            thread.start()
+
+    def lazy_reembed(self) -> None:
+        """
+        Re-embed stale rows (untagged or from another embedder) in small chunks, newest first, until none are left.
+        Incompatible rows are ignored by retrieval in the meantime.
+        """
+        tables = [("messages", "message"), ("summaries", "summary"), ("graph_context", "context")]
+        total = 0
+        while True:
+            count = 0
+            for table, text_column in tables:
+                count += self.reembed_chunk(table, text_column)
+            if count == 0:
+                break
+            total += count
+            time.sleep(self.gs.config["lazy_reembed_interval"])
+
+        if total > 0:
+            logger.info(f"Lazy re-embedding finished, {total} rows upgraded")
+
+    def reembed_chunk(self, table: str, text_column: str) -> int:
+        """
+        Re-embed one chunk of stale rows. The database is only locked for reading and writing, not while encoding.
+        :return: number of upgraded rows
+        """
+        db_manager = self.gs.db_manager
+        embedder = self.embedder_id
+        batch_size = self.gs.config["embedding_batch_size"]
+
+        if table == "graph_context":
+            sql = "select graph_context.id, summaries.character_id, graph_context.token_count, " \
+                  "graph_context.context as text from graph_context " \
+                  "left join summaries on summaries.id = graph_context.summary_id " \
+                  "where (graph_context.embedding is not null or graph_context.embedding_offset is not null) " \
+                  "and (graph_context.embedding_model is null or graph_context.embedding_model != ?) " \
+                  "order by graph_context.id desc limit ?"
         else:
-            sql = f"select * from summaries where id = {id}"
-        res = cur.execute(sql)
-        res = res.fetchall()
-        for r in res:
-            id = r["id"]
-            summary = r["summary"]
+            sql = f"select id, character_id, token_count, {text_column} as text from {table} " \
+                  f"where (embedding is not null or embedding_offset is not null) " \
+                  f"and (embedding_model is null or embedding_model != ?) order by id desc limit ?"
+
+        with db_manager.lock:
+            res = db_manager.con.execute(sql, (embedder, batch_size)).fetchall()
+        if len(res) == 0:
+            return 0
+
+        embeddings = self.model.encode([row["text"] or "" for row in res], batch_size=batch_size)
 
-            embeddings = self.model.encode(summary)
-            blob = np_to_blob(embeddings)
+        with db_manager.transaction():
+            self.store_embeddings(table, [row["character_id"] for row in res], [row["id"] for row in res], embeddings)
+            if table != "graph_context":
+                for row, embedding in zip(res, embeddings):
+                    self.update_index(table == "messages", row["character_id"], row["id"], row["token_count"], embedding)
 
-            sql = "update summaries set embedding = ? where id = ?"
-            cur.execute(sql, (sqlite3.Binary(blob), id))
-        con.commit()
+        return len(res)
+
+    def text_to_embedding(self, text):
+        return self.encode_cached([text])[0]
+
+    def encode_cached(self, texts: [str]) -> np.ndarray:
+        """
+        Encode texts with the current embedder.
+        Embeddings are cached by content hash and embedder, all uncached texts are encoded with one encode call.
+        :param texts: list of texts
+        :return: 2d array with one embedding per text
+        """
+        embedder = self.embedder_id
+        keys = [hashlib.sha1((embedder + "\0" + text).encode("utf-8")).digest() for text in texts]
+        embeddings = [None] * len(texts)
+        missing = []
+
+        with self.query_cache_lock:
+            for i, key in enumerate(keys):
+                if key in self.query_cache:
+                    self.query_cache.move_to_end(key)
+                    embeddings[i] = self.query_cache[key]
+                else:
+                    missing.append(i)
+
+        if len(missing) > 0:
+            unique = list(OrderedDict.fromkeys(texts[i] for i in missing))
+            encoded = {}
+            for text, embedding in zip(unique, self.model.encode(unique)):
+                encoded[text] = embedding
+
+            cache_size = self.gs.config["query_embedding_cache_size"]
+            with self.query_cache_lock:
+                for i in missing:
+                    embeddings[i] = encoded[texts[i]]
+                    self.query_cache[keys[i]] = embeddings[i]
+                while len(self.query_cache) > cache_size:
+                    self.query_cache.popitem(last=False)
+
+        if len(embeddings) == 0:
+            return np.empty((0, self.get_dimension()), dtype=np.float32)
+        return np.row_stack(embeddings)
 
     def text_to_embedding_blob(self, text):
-        embeddings = self.model.encode(text)
-        blob = np_to_blob(embeddings)
+        embeddings = self.text_to_embedding(text)
+        blob = np_to_blob(embeddings, self.gs.config["embedding_dtype"])
         return blob
 
-    def get_results_db(self, is_message: bool, character_id: int, text: str, count: int) -> dict:
-        con = self.gs.db_manager.con
-        cur = self.gs.db_manager.cur
+    def get_sidecar(self, table: str, character_id: int, embedding_model: str) -> EmbeddingSidecar:
+        """
+        Get the memory-mapped embedding file of a table, character and embedder.
+        Every embedder gets its own file because the row size depends on the dimension.
+        """
+        key = (table, character_id, embedding_model)
+        if key not in self.sidecars:
+            if embedding_model is None:
+                name = f"{table}_{character_id}.f32"
+            else:
+                tag = hashlib.sha1(embedding_model.encode("utf-8")).hexdigest()[:8]
+                name = f"{table}_{character_id}_{tag}.f32"
+            path = os.path.join(self.gs.config["embedding_sidecar_path"], name)
+            self.sidecars[key] = EmbeddingSidecar(path)
+        return self.sidecars[key]
 
-        embedding_src = self.model.encode(text)
+    def store_embedding(self, table: str, character_id: int, id: int, embedding) -> None:
+        """
+        Write an embedding either as blob into the row or into the sidecar file of the character, depending on
+        embedding_storage. Does not commit.
+        :param table: messages, summaries or graph_context
+        :param character_id: character the row belongs to
+        :param id: row id
+        :param embedding: 1d embedding
+        """
+        self.store_embeddings(table, [character_id], [id], [embedding])
 
-        if is_message:
-            res = cur.execute("select * from messages where character_id = ?", (character_id,)).fetchall()
+    def store_embeddings(self, table: str, character_ids: [int], ids: [int], embeddings) -> None:
+        """
+        Batched store_embedding, all rows are written with one executemany. Does not commit.
+        Every embedding is tagged with the configured embedder.
+        """
+        cur = self.gs.db_manager.cur
+        embedder = self.embedder_id
+
+        rows = []
+        if self.gs.config["embedding_storage"] == "sidecar":
+            # One write per sidecar file
+            groups = OrderedDict()
+            for character_id, id, embedding in zip(character_ids, ids, embeddings):
+                groups.setdefault(character_id, []).append((id, embedding))
+            for character_id, group in groups.items():
+                offsets = self.get_sidecar(table, character_id, embedder).append_many([e for id, e in group])
+                rows.extend((offset, embedder, id) for offset, (id, e) in zip(offsets, group))
+            sql = f"update {table} set embedding = null, embedding_offset = ?, embedding_model = ? where id = ?"
         else:
-            res = cur.execute("select * from summaries where character_id = ?", (character_id,)).fetchall()
+            dtype = self.gs.config["embedding_dtype"]
+            for id, embedding in zip(ids, embeddings):
+                rows.append((np_to_blob(embedding, dtype), embedder, id))
+            sql = f"update {table} set embedding = ?, embedding_offset = null, embedding_model = ? where id = ?"
+        cur.executemany(sql, rows)
 
-        class Item():
-            def __init__(self, id, distance, token_count):
-                self.id = id
-                self.distance = distance
-                self.token_count = token_count
+    def load_embeddings(self, table: str, rows) -> ([int], np.ndarray):
+        """
+        Get the embeddings of database rows that are compatible with the current embedder as 2d array.
+        Rows need the columns character_id, embedding, embedding_offset and embedding_model. Rows in the sidecar are
+        gathered from the memmap view, rows with blobs are decoded. Rows tagged with another embedder are skipped,
+        untagged rows are used if their dimension matches.
+        :return: positions of the used rows in rows, 2d array with one embedding per used row
+        """
+        embedder = self.embedder_id
+        dim = self.get_dimension()
+
+        data = [None] * len(rows)
+        offsets = {}
+        for i, row in enumerate(rows):
+            model = row["embedding_model"]
+            if model is not None and model != embedder:
+                continue
+            if row["embedding_offset"] is not None:
+                offsets.setdefault((row["character_id"], model), []).append((i, row["embedding_offset"]))
+            elif row["embedding"] is not None:
+                data[i] = blob_to_np(row["embedding"])
+
+        for (character_id, model), lst in offsets.items():
+            view = self.get_sidecar(table, character_id, model).view()
+            gathered = view[[offset for i, offset in lst]]
+            for j, (i, offset) in enumerate(lst):
+                data[i] = gathered[j]
+
+        positions = [i for i, d in enumerate(data) if d is not None and d.shape[-1] == dim]
+        if len(positions) == 0:
+            return [], np.empty((0, dim), dtype=np.float32)
+        return positions, np.row_stack([data[i] for i in positions])
+
+    def get_dimension(self) -> int:
+        """
+        Dimension of the vectors of the current embedder.
+        """
+        return self.model.get_dimension()
 
-        items = []
-        for i, row in enumerate(res):
-            id = row["id"]
-            blob = row["embedding"]
-            token_count = row["token_count"]
-            embedding = blob_to_np(blob)
-
-            distance = l2_squared(embedding_src, embedding)
-            items.append(Item(id, distance, token_count))
-
-        new_list = sorted(items, key=lambda x: x.distance, reverse=False)
-        res = {
-            "ids": [],
-            "distances": [],
-            "token_counts": [],
-        }
-        for i in range(count):
-            if i >= len(new_list):
-                break
-            res["ids"].append(new_list[i].id)
-            res["distances"].append(new_list[i].distance)
-            res["token_counts"].append(new_list[i].token_count)
+    def get_index(self, is_message: bool, character_id: int) -> Optional[EmbeddingIndex]:
+        """
+        Get the resident embedding index of a character. Load it from the database on first access.
+        Only embeddings that are compatible with the current embedder are part of the index.
+        :param is_message: messages or summaries table
+        :param character_id: character
+        :return: index or None if there are no embeddings yet
+        """
+        key = (is_message, character_id)
+        if key in self.indices:
+            return self.indices[key]
 
-        return res
+        cur = self.gs.db_manager.cur
+        if is_message:
+            table = "messages"
+        else:
+            table = "summaries"
+        sql = f"select id, character_id, token_count, embedding, embedding_offset, embedding_model from {table} " \
+              f"where character_id = ? and (embedding is not null or embedding_offset is not null) " \
+              f"and (embedding_model is null or embedding_model = ?) order by id asc"
+        res = cur.execute(sql, (character_id, self.embedder_id)).fetchall()
+
+        positions, matrix = self.load_embeddings(table, res)
+        if len(positions) == 0:
+            return None
+
+        index = EmbeddingIndex(matrix.shape[1])
+        index.append([res[i]["id"] for i in positions], [res[i]["token_count"] for i in positions], matrix)
+        self.indices[key] = index
+        return index
+
+    def update_index(self, is_message: bool, character_id: int, id: int, token_count: int, embedding) -> None:
+        """
+        Append a freshly calculated embedding to the index if the index is already loaded.
+        Unloaded indices pick up the row from the database on their first access.
+        """
+        key = (is_message, character_id)
+        if key in self.indices:
+            self.indices[key].append([id], [token_count], embedding)
+
+    def invalidate_index(self, is_message: bool = None, character_id: int = None) -> None:
+        """
+        Drop resident indices so they are reloaded from the database on next access.
+        :param is_message: only drop indices of this table, None for both
+        :param character_id: only drop indices of this character, None for all
+        """
+        for key in list(self.indices.keys()):
+            if is_message is not None and key[0] != is_message:
+                continue
+            if character_id is not None and key[1] != character_id:
+                continue
+            del self.indices[key]
 
-    def get_related_messages(self, current_character_id, mem_ustm, mem_ltm_temp, max_token_count):
+    def get_results_db(self, is_message: bool, character_id: int, text: str, count: int) -> dict:
+        embedding_src = self.text_to_embedding(text)
+
+        index = self.get_index(is_message, character_id)
+        if index is None:
+            return {
+                "ids": [],
+                "distances": [],
+                "token_counts": [],
+            }
+        return index.query(embedding_src, count)
+
+    def get_results_db_many(self, character_id: int, ids: [int], max_id: int, count: int) -> [dict]:
+        """
+        Batched get_results_db for a list of messages.
+        The query vectors are taken from the resident index or the stored embeddings of the messages, only messages
+        without a usable embedding are encoded (with one encode call, through the query cache). All queries are
+        scored against the candidate messages with one matrix multiply.
+        :param character_id: character
+        :param ids: message ids used as queries
+        :param max_id: only messages with a smaller id are scored
+        :param count: max results per query
+        :return: one result dict per id in ids
+        """
+        if len(ids) == 0:
+            return []
+
+        index = self.get_index(True, character_id)
+        if index is None:
+            return [{"ids": [], "distances": [], "token_counts": []} for id in ids]
+
+        embeddings = np.empty((len(ids), index.dim), dtype=np.float32)
+        missing = []
+        for i, id in enumerate(ids):
+            pos = index.position(id)
+            if pos >= 0:
+                embeddings[i] = index.matrix[pos]
+            else:
+                missing.append(i)
+
+        if len(missing) > 0:
+            res = self.gs.db_manager.fetch_rows("messages", [ids[i] for i in missing],
+                                                ["character_id", "message", "embedding", "embedding_offset",
+                                                 "embedding_model"])
+            rows = {}
+            for row in res:
+                rows[row["id"]] = row
+            stored = [rows[ids[i]] for i in missing if ids[i] in rows]
+            positions, matrix = self.load_embeddings("messages", stored)
+            found = {}
+            for j, pos in enumerate(positions):
+                found[stored[pos]["id"]] = matrix[j]
+
+            to_encode = [i for i in missing if ids[i] not in found]
+            for i in missing:
+                if ids[i] in found:
+                    embeddings[i] = found[ids[i]]
+            if len(to_encode) > 0:
+                texts = [(rows[ids[i]]["message"] or "") if ids[i] in rows else "" for i in to_encode]
+                embeddings[to_encode] = self.encode_cached(texts)
+
+        return index.query_many(embeddings, count, max_id=max_id)
+
+    def get_related_messages(self, current_character_id, mem_ustm, ltm_boundary_id, max_token_count):
         class MsgItem:
             def __init__(self, id, priority, token_count):
                 self.id = id
@@ -205,21 +517,17 @@ class ChromaManager:
         token_count_ltm = 0
 
         chroma_dict = OrderedDict()
-        tmp = []
-        for id in mem_ustm:
-            msg = self.gs.message_manager.get_message_per_id(id)
-            vecs = self.get_results_db(is_message=True, character_id=current_character_id, text=msg, count=100)
-
+        for vecs in self.get_results_db_many(character_id=current_character_id, ids=mem_ustm,
+                                             max_id=ltm_boundary_id, count=100):
             for i in range(len(vecs["ids"])):
                 id = vecs["ids"][i]
                 dist = vecs["distances"][i]
                 tc = vecs["token_counts"][i]
                 prio = 3 - dist
 
-                if id in mem_ltm_temp and id not in tmp and prio >= 0:
+                if id < ltm_boundary_id and id not in chroma_dict and prio >= 0:
                     item = MsgItem(id, prio, tc)
                     chroma_dict[id] = item
-                    tmp.append(id)
 
         lst_tmp = []
         prios = []
@@ -239,4 +547,19 @@ class ChromaManager:
             mem_ltm.append(item.id)
             token_count_ltm += item.token_count
 
-        return mem_ltm
\ No newline at end of file
+        return mem_ltm
+
+
+def create_embedder(backend: str) -> EmbedderBase:
+    """
+    Create and load the embedder of a backend.
+    :param backend: sentence_transformers or onnx
+    """
+    if backend == "onnx":
+        from chatbot.embedder.embedder_onnx import EmbedderOnnx
+        embedder = EmbedderOnnx()
+    else:
+        from chatbot.embedder.embedder_sentence_transformers import EmbedderSentenceTransformers
+        embedder = EmbedderSentenceTransformers()
+    embedder.init_embedder()
+    return embedder
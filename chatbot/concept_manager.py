@@ -308,7 +308,12 @@ class ConceptManager():
 
         return concepts_chunks
 
-    def calc_concepts_summaries(self, id):
+    def calc_concepts_summaries(self, id, concepts=None):
+        """
+        Extract the concepts of summaries and store them in the graph tables.
+        :param id: summary id, None for all summaries
+        :param concepts: concepts of the summary from fetch_concepts_from_texts if they were already fetched
+        """
         con = self.gs.db_manager.con
         cur = self.gs.db_manager.cur
 
@@ -337,10 +342,11 @@ class ConceptManager():
             else:
                 cur.execute("insert into graph_relations (src_node_id, dest_node_id, revision_count) values (?, ?, ?)", (src, dest, 1))
 
-        def insert_context(sum_id, concept_name, concept_context, context_embedding, tc):
+        def insert_context(sum_id, character_id, concept_name, concept_context, context_embedding, tc):
             node = get_concept_id(concept_name)
-            cur.execute("insert into graph_context (node_id, summary_id, context, token_count, embedding) values (?, ?, ?, ?, ?)",
-                        (node, sum_id, concept_context, tc, sqlite3.Binary(context_embedding)))
+            cur.execute("insert into graph_context (node_id, summary_id, context, token_count) values (?, ?, ?, ?)",
+                        (node, sum_id, concept_context, tc))
+            self.gs.chroma_manager.store_embedding("graph_context", character_id, cur.lastrowid, context_embedding)
 
         if id is None:
             sql = "select * from summaries"
@@ -352,21 +358,26 @@ class ConceptManager():
             summary_id = r["id"]
             summary = r["summary"]
 
-            concepts = self.fetch_concepts_from_texts([summary])
+            if concepts is None or id is None:
+                concepts = self.fetch_concepts_from_texts([summary])
+
+            contexts = [concept.context for chunk in concepts for concept in chunk]
+            token_counts = self.gs.model_manager.get_token_counts(contexts)
 
+            i = 0
             for chunk in concepts:
                 for mini_batch_i, concept in enumerate(chunk):
                     upsert_concept(concept.name)
-                    blob = self.gs.chroma_manager.text_to_embedding_blob(concept.context)
-                    token_count = self.gs.model_manager.get_token_count(concept.context)
-                    insert_context(summary_id, concept.name, concept.context, blob, token_count)
+                    embedding = self.gs.chroma_manager.text_to_embedding(concept.context)
+                    insert_context(summary_id, r["character_id"], concept.name, concept.context, embedding, token_counts[i])
+                    i += 1
 
             for chunk in concepts:
                 for mini_batch_i, concept in enumerate(chunk):
                     for rel_concept in concept.related_concepts:
                         upsert_relation(concept.name, rel_concept.name)
 
-            con.commit()
+            self.gs.db_manager.commit()
 
     def get_context_id(self, id: int) -> str:
         con = self.gs.db_manager.con
@@ -379,12 +390,23 @@ class ConceptManager():
         return ""
 
     def id_list_to_block(self, lst):
+        rows = self.gs.db_manager.fetch_rows("graph_context", lst, ["context"])
         text = ""
-        for id in lst:
-            text = text + self.get_context_id(id) + "\n"
+        for row in rows:
+            text = text + row["context"] + "\n"
         return text.strip()
 
     def get_current_thoughts(self, character_id, summary_count, max_tokens):
+        final_id_list = self.get_current_thought_ids(character_id, summary_count, max_tokens)
+        text = self.id_list_to_block(final_id_list)
+        emotions = self.gs.emotion_manager.get_emotion_from_ids(False, character_id, final_id_list)
+        return text, emotions
+
+    def get_current_thought_ids(self, character_id, summary_count, max_tokens) -> [int]:
+        """
+        Pick graph contexts of the concepts in the latest summaries, one per cluster, up to max_tokens.
+        :return: graph_context ids
+        """
         con = self.gs.db_manager.con
         cur = self.gs.db_manager.cur
 
@@ -409,20 +431,19 @@ class ConceptManager():
             if len(res) > 0:
                 concept_ids.append(str(res[0]["id"]))
 
-        sql = "select * from graph_context where node_id in ({seq})".format(seq=','.join(concept_ids))
+        sql = "select graph_context.id, graph_context.token_count, graph_context.embedding, " \
+              "graph_context.embedding_offset, graph_context.embedding_model, summaries.character_id " \
+              "from graph_context left join summaries on summaries.id = graph_context.summary_id " \
+              "where graph_context.node_id in ({seq})".format(seq=','.join(concept_ids))
         res = cur.execute(sql).fetchall()
 
+        positions, d = self.gs.chroma_manager.load_embeddings("graph_context", res)
+
         ids = []
-        data = []
         token_count_map = {}
-        for row in res:
-            ids.append(row["id"])
-            blob = row["embedding"]
-            token_count_map[row["id"]] = row["token_count"]
-            embedding = blob_to_np(blob)
-            data.append(embedding)
-
-        d = np.row_stack(data)
+        for i in positions:
+            ids.append(res[i]["id"])
+            token_count_map[res[i]["id"]] = res[i]["token_count"]
 
         umap_model = UMAP(n_neighbors=15, n_components=6, min_dist=0.0, metric='cosine')
         tmp = umap_model.fit_transform(d)
@@ -458,6 +479,4 @@ class ConceptManager():
             final_id_list.append(id)
             token_count += token_count_map[id]
 
-        text = self.id_list_to_block(final_id_list)
-        emotions = self.gs.emotion_manager.get_emotion_from_ids(False, character_id, final_id_list)
-        return text, emotions
+        return final_id_list
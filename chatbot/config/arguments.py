@@ -1,6 +1,8 @@
 import argparse
 from typing import List
 
+BACKFILLS = ["nsfw", "emotions", "embeddings", "embedding_format"]
+
 def validate_arguments(args: List[str]) -> argparse.Namespace:
     """
     Parse the command line arguments and check for validity.
@@ -10,5 +12,7 @@ def validate_arguments(args: List[str]) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description='execute chatbot')
 
     parser.add_argument('config', metavar="CONFIG", type=str, help='path to config file')
+    parser.add_argument('--backfill', type=str, choices=BACKFILLS, default=None,
+                        help='run a one-shot database backfill and exit')
     
     return parser.parse_args(args=args)
\ No newline at end of file
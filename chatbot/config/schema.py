@@ -20,6 +20,11 @@ config_schema = \
                 "type": "integer",
                 "description": "how long prompts should be",
             },
+            "candidate_count": {
+                "type": "integer",
+                "description": "responses sampled at once when check_similarity is on, the least repetitive one that passes the checks is used",
+                "default": 1
+            },
             "max_jaro_distance": {
                 "type": "number",
                 "description": "max jaro distance to prevent model from generating too similar responses",
@@ -35,6 +40,34 @@ config_schema = \
                 "description": "path to database",
                 "default": "./database/database.db"
             },
+            "sqlite_journal_mode": {
+                "type": "string",
+                "description": "journal mode of the database",
+                "default": "wal",
+                "enum": ["delete", "truncate", "persist", "memory", "wal"]
+            },
+            "sqlite_synchronous": {
+                "type": "string",
+                "description": "how often sqlite syncs to disk. normal is safe in wal mode",
+                "default": "normal",
+                "enum": ["off", "normal", "full", "extra"]
+            },
+            "sqlite_mmap_size": {
+                "type": "integer",
+                "description": "bytes of the database file that are memory mapped. 0 to disable",
+                "default": 268435456
+            },
+            "sqlite_cache_size": {
+                "type": "integer",
+                "description": "page cache size. negative values are in KiB, positive values in pages",
+                "default": -65536
+            },
+            "sqlite_temp_store": {
+                "type": "string",
+                "description": "where temporary tables and indices are stored",
+                "default": "memory",
+                "enum": ["default", "file", "memory"]
+            },
             "prompt_path": {
                 "type": "string",
                 "description": "path to latest promps for debugging",
@@ -72,6 +105,31 @@ config_schema = \
                 "type": "string",
                 "description": "ip and port of koboldcpp or similar to use as summarizer",
             },
+            "stm_trim_slack": {
+                "type": "number",
+                "description": "fraction of the stm budget that is dropped at once when the stm is full, keeps the start of the prompt stable between turns, only used with gguf_prompt_cache",
+                "default": 0.25
+            },
+            "token_count_cache_size": {
+                "type": "integer",
+                "description": "how many token counts of texts are cached",
+                "default": 4096
+            },
+            "query_embedding_cache_size": {
+                "type": "integer",
+                "description": "how many embeddings of query texts are cached",
+                "default": 1024
+            },
+            "async_enrichment": {
+                "type": "boolean",
+                "description": "calculate emotions, embeddings and summaries of new messages in background threads",
+                "default": False
+            },
+            "enrichment_workers": {
+                "type": "integer",
+                "description": "number of background enrichment threads",
+                "default": 1
+            },
             "summarizer_message_count": {
                 "type": "integer",
                 "description": "how many of the previous messages should be summarized",
@@ -86,6 +144,59 @@ config_schema = \
                 "description": "custom embedder",
                 "default": ""
             },
+            "embedder_backend": {
+                "type": "string",
+                "description": "runtime of the embedder: sentence_transformers (pytorch) or onnx (onnx runtime on cpu)",
+                "enum": ["sentence_transformers", "onnx"],
+                "default": "sentence_transformers"
+            },
+            "embedder_onnx_path": {
+                "type": "string",
+                "description": "directory for the exported onnx embedders",
+                "default": "./database/onnx/"
+            },
+            "embedder_onnx_quantize": {
+                "type": "boolean",
+                "description": "quantize the onnx embedder to int8, its embeddings are tagged as a separate embedder",
+                "default": False
+            },
+            "embedder_threads": {
+                "type": "integer",
+                "description": "intra op threads of the onnx embedder, 0 for the onnx runtime default",
+                "default": 0
+            },
+            "embedding_batch_size": {
+                "type": "integer",
+                "description": "how many texts are embedded at once when backfilling embeddings",
+                "default": 64
+            },
+            "lazy_reembed": {
+                "type": "boolean",
+                "description": "re-embed rows from other or unknown embedders in the background, enable after changing chromadb_embedder",
+                "default": False
+            },
+            "lazy_reembed_interval": {
+                "type": "number",
+                "description": "seconds to wait between chunks of background re-embedding",
+                "default": 1.0
+            },
+            "embedding_dtype": {
+                "type": "string",
+                "description": "precision embeddings are stored with in the database",
+                "default": "float32",
+                "enum": ["float32", "float16"]
+            },
+            "embedding_storage": {
+                "type": "string",
+                "description": "store embeddings as blobs in the database or in memory-mapped sidecar files per character",
+                "default": "sqlite",
+                "enum": ["sqlite", "sidecar"]
+            },
+            "embedding_sidecar_path": {
+                "type": "string",
+                "description": "folder for embedding sidecar files",
+                "default": "./database/embeddings/"
+            },
             "memory_summary_length": {
                 "type": "integer",
                 "description": "max token allowance for memories in summary form",
@@ -136,6 +247,21 @@ config_schema = \
                 "description": "should bot notify in telegram that it is running?",
                 "default": True
             },
+            "hf_batching": {
+                "type": "boolean",
+                "description": "batch concurrent generation requests (chat, summaries) into one generate call",
+                "default": False
+            },
+            "hf_max_batch_size": {
+                "type": "integer",
+                "description": "max requests per batched generate call",
+                "default": 8
+            },
+            "hf_batch_wait": {
+                "type": "number",
+                "description": "seconds to wait for more requests before a batch is started",
+                "default": 0.02
+            },
             "hf_max_gpu_memory": {
                 "type": "integer",
                 "description": "how much gpu memory can me used. for accelerate. 0 for unlimited",
@@ -148,9 +274,14 @@ config_schema = \
             },
             "message_streaming": {
                 "type": "boolean",
-                "description": "stream parts of messages to telegram",
+                "description": "stream parts of messages to telegram and the web ui",
                 "default": False
             },
+            "message_streaming_interval": {
+                "type": "number",
+                "description": "min seconds between two edits of a streamed message",
+                "default": 1.0
+            },
             "gguf_quantization": {
                 "type": "string",
                 "description": "quantization level for gguf creation",
@@ -172,6 +303,22 @@ config_schema = \
                 "description": "how many gpu layers should be loaded by llama.cpp",
                 "default": 128
             },
+            "gguf_prompt_cache": {
+                "type": "string",
+                "description": "keep llama.cpp states of previous prompts and continue from the longest common token prefix",
+                "default": "off",
+                "enum": ["off", "ram", "disk"]
+            },
+            "gguf_prompt_cache_size": {
+                "type": "integer",
+                "description": "max size of the llama.cpp prompt cache in bytes",
+                "default": 2147483648
+            },
+            "gguf_prompt_cache_path": {
+                "type": "string",
+                "description": "directory of the disk prompt cache, one subdirectory per model",
+                "default": "./database/gguf_cache/"
+            },
             "gguf_generation_parameters": {
                 "type": "object",
                 "description": "",
@@ -207,12 +354,32 @@ config_schema = \
                 "description": "hf name or path to emotion classifier",
                 "default": "nateraw/bert-base-uncased-emotion"
             },
+            "nsfw_batch_size": {
+                "type": "integer",
+                "description": "how many messages are classified at once when backfilling nsfw ratios",
+                "default": 32
+            },
+            "emotion_batch_size": {
+                "type": "integer",
+                "description": "how many messages are classified at once when recalculating emotions",
+                "default": 32
+            },
             "banned_phrases": {
                 "type": "array",
                 "description": "phrases that must not be generated",
                 "items": {"type": "string"},
                 "default": []
             },
+            "banned_phrases_word_boundaries": {
+                "type": "boolean",
+                "description": "banned phrases only match whole words",
+                "default": False
+            },
+            "early_abort": {
+                "type": "boolean",
+                "description": "stop generating a response as soon as it contains a banned phrase or a too similar sentence",
+                "default": True
+            },
             "summarizer_omit_nsfw": {
                 "type": "boolean",
                 "description": "don't summarize messages that are rated nsfw",
@@ -1,7 +1,22 @@
 import sqlite3
+import logging
 import os
+import threading
+from contextlib import contextmanager
 
 from chatbot.global_state import GlobalState
+from chatbot.utils import np_to_blob, blob_to_np, is_legacy_blob
+
+logger = logging.getLogger('db_manager')
+
+EMBEDDING_TABLES = ["messages", "summaries", "graph_context"]
+
+# Bit flags for messages.enrichment
+ENRICH_EMOTIONS = 1
+ENRICH_EMBEDDING = 2
+ENRICH_SUMMARY = 4
+ENRICH_ALL = ENRICH_EMOTIONS | ENRICH_EMBEDDING | ENRICH_SUMMARY
+MAX_SQL_VARIABLES = 900
 
 DB_SCHEMA = """
 CREATE TABLE IF NOT EXISTS "summaries_messages" (
@@ -36,6 +51,7 @@ CREATE TABLE IF NOT EXISTS "messages" (
 	"telegram_chat_id"	INTEGER,
 	"telegram_message_id"	INTEGER,
 	"nsfw_ratio"	NUMERIC,
+	"enrichment"	INTEGER,
 	"caring"	REAL,
 	"faithful"	REAL,
 	"content"	REAL,
@@ -69,6 +85,8 @@ CREATE TABLE IF NOT EXISTS "messages" (
 	"disappointed"	REAL,
 	"embarrassed"	REAL,
 	"embedding"	BLOB,
+	"embedding_offset"	INTEGER,
+	"embedding_model"	TEXT,
 	PRIMARY KEY("id" AUTOINCREMENT)
 );
 CREATE TABLE IF NOT EXISTS "summaries" (
@@ -112,6 +130,8 @@ CREATE TABLE IF NOT EXISTS "summaries" (
 	"disappointed"	REAL,
 	"embarrassed"	REAL,
 	"embedding"	BLOB,
+	"embedding_offset"	INTEGER,
+	"embedding_model"	TEXT,
 	PRIMARY KEY("id" AUTOINCREMENT)
 );
 CREATE TABLE IF NOT EXISTS "graph_nodes" (
@@ -135,15 +155,95 @@ CREATE TABLE IF NOT EXISTS "graph_context" (
 	"context"	TEXT,
 	"token_count"	INTEGER,
 	"embedding"	BLOB,
+	"embedding_offset"	INTEGER,
+	"embedding_model"	TEXT,
 	PRIMARY KEY("id" AUTOINCREMENT)
 );
 """
 
+def migration_embedding_offset(cur) -> None:
+    """
+    Add the sidecar offset column to all tables with embeddings.
+    """
+    for table in EMBEDDING_TABLES:
+        columns = [row["name"] for row in cur.execute(f"pragma table_info({table})").fetchall()]
+        if "embedding_offset" not in columns:
+            cur.execute(f"alter table {table} add column embedding_offset INTEGER")
+
+
+def migration_indexes(cur) -> None:
+    """
+    Add indexes for the hot queries. Duplicate concept names are merged into the oldest node first so the unique
+    index on graph_nodes.name can be created.
+    """
+    res = cur.execute("select name, min(id) as keep_id from graph_nodes group by name having count(*) > 1").fetchall()
+    for row in res:
+        duplicates = cur.execute("select id from graph_nodes where name = ? and id != ?",
+                                 (row["name"], row["keep_id"])).fetchall()
+        for dup in duplicates:
+            cur.execute("update graph_context set node_id = ? where node_id = ?", (row["keep_id"], dup["id"]))
+            cur.execute("update graph_relations set src_node_id = ? where src_node_id = ?", (row["keep_id"], dup["id"]))
+            cur.execute("update graph_relations set dest_node_id = ? where dest_node_id = ?", (row["keep_id"], dup["id"]))
+            cur.execute("delete from graph_nodes where id = ?", (dup["id"],))
+
+    cur.execute("create index if not exists idx_messages_character_id on messages (character_id, id)")
+    cur.execute("create index if not exists idx_summaries_character_id on summaries (character_id, id)")
+    cur.execute("create index if not exists idx_summaries_last_message_id on summaries (last_message_id)")
+    cur.execute("create unique index if not exists idx_graph_nodes_name on graph_nodes (name)")
+    cur.execute("create index if not exists idx_graph_relations_nodes on graph_relations (src_node_id, dest_node_id)")
+    cur.execute("create index if not exists idx_graph_context_node_id on graph_context (node_id)")
+
+
+def migration_enrichment(cur) -> None:
+    """
+    Add the enrichment status of messages. Existing messages were enriched synchronously.
+    """
+    columns = [row["name"] for row in cur.execute("pragma table_info(messages)").fetchall()]
+    if "enrichment" not in columns:
+        cur.execute("alter table messages add column enrichment INTEGER")
+    cur.execute("update messages set enrichment = ? where enrichment is null", (ENRICH_ALL,))
+
+
+def migration_embedding_model(cur) -> None:
+    """
+    Tag embeddings with the embedder that produced them. Existing embeddings stay untagged, their embedder is
+    unknown. Retrieval still uses them if their dimension matches, re-embedding replaces them.
+    """
+    for table in EMBEDDING_TABLES:
+        columns = [row["name"] for row in cur.execute(f"pragma table_info({table})").fetchall()]
+        if "embedding_model" not in columns:
+            cur.execute(f"alter table {table} add column embedding_model TEXT")
+
+
+# (user_version, migration) in ascending order, never change or reorder released entries
+MIGRATIONS = [
+    (1, migration_embedding_offset),
+    (2, migration_indexes),
+    (3, migration_enrichment),
+    (4, migration_embedding_model),
+]
+
+
+def apply_connection_profile(con: sqlite3.Connection, config) -> None:
+    """
+    Apply the sqlite tuning settings from the config to a fresh connection.
+    :param con: connection
+    :param config: config dict with the sqlite_* settings
+    """
+    con.execute(f"pragma journal_mode = {config['sqlite_journal_mode']}")
+    con.execute(f"pragma synchronous = {config['sqlite_synchronous']}")
+    con.execute(f"pragma mmap_size = {int(config['sqlite_mmap_size'])}")
+    con.execute(f"pragma cache_size = {int(config['sqlite_cache_size'])}")
+    con.execute(f"pragma temp_store = {config['sqlite_temp_store']}")
+
+
 class DbManager:
     def __init__(self):
         self.gs = GlobalState()
         self.con = None
         self.cur = None
+        self.lock = threading.RLock()
+        self.transaction_depth = 0
         self.init_database()
 
     def init_database(self) -> None:
@@ -163,6 +263,110 @@ class DbManager:
             self.cur.executescript(DB_SCHEMA)
             self.con.commit()
 
+        apply_connection_profile(self.con, self.gs.config)
+        self.migrate()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group several manager calls into one transaction.
+        Calls to commit() inside the block are deferred until the outermost block exits, an exception rolls
+        everything back. Blocks can be nested.
+        """
+        with self.lock:
+            self.transaction_depth += 1
+            try:
+                yield self
+            except Exception:
+                self.transaction_depth -= 1
+                if self.transaction_depth == 0:
+                    self.con.rollback()
+                raise
+            self.transaction_depth -= 1
+            if self.transaction_depth == 0:
+                self.con.commit()
+
+    def commit(self) -> None:
+        """
+        Commit unless a transaction block is active.
+        Waits for transaction blocks of other threads, inside a block of this thread the commit is deferred.
+        """
+        with self.lock:
+            if self.transaction_depth == 0:
+                self.con.commit()
+
+    def fetch_rows(self, table: str, ids: [int], columns: [str]) -> [sqlite3.Row]:
+        """
+        Fetch many rows by id with as few queries as possible.
+        :param table: table name
+        :param ids: row ids, the result has the same order
+        :param columns: columns to select, id is always selected
+        :return: rows, ids that don't exist are skipped
+        """
+        if len(ids) == 0:
+            return []
+
+        cols = ", ".join(["id"] + [c for c in columns if c != "id"])
+        unique = list(dict.fromkeys(ids))
+        rows = {}
+        for i in range(0, len(unique), MAX_SQL_VARIABLES):
+            chunk = unique[i:i + MAX_SQL_VARIABLES]
+            sql = f"select {cols} from {table} where id in ({','.join(['?'] * len(chunk))})"
+            for row in self.con.execute(sql, chunk).fetchall():
+                rows[row["id"]] = row
+
+        return [rows[id] for id in ids if id in rows]
+
+    def migrate(self) -> None:
+        """
+        Apply all schema migrations newer than the user_version of the database.
+        Every migration runs in its own transaction together with the version bump.
+        """
+        version = self.cur.execute("pragma user_version").fetchone()[0]
+        for target, migration in MIGRATIONS:
+            if target <= version:
+                continue
+
+            logger.info(f"Migrating database to version {target}...")
+            self.cur.execute("begin")
+            try:
+                migration(self.cur)
+                self.cur.execute(f"pragma user_version = {target}")
+                self.con.commit()
+            except Exception:
+                self.con.rollback()
+                raise
+            version = target
+
+    def migrate_embedding_format(self, batch_size: int = 1000) -> None:
+        """
+        Rewrite all embeddings that were stored with np.save in the compact format.
+        Every table is processed in batches, each batch is read and written in one transaction.
+        Run it with --backfill embedding_format.
+        :param batch_size: rows per transaction
+        """
+        dtype = self.gs.config["embedding_dtype"]
+        for table in EMBEDDING_TABLES:
+            last_id = -1
+            converted = 0
+            while True:
+                with self.transaction():
+                    sql = f"select id, embedding from {table} where id > ? and embedding is not null order by id asc limit ?"
+                    res = self.cur.execute(sql, (last_id, batch_size)).fetchall()
+                    if len(res) == 0:
+                        break
+
+                    rows = []
+                    for row in res:
+                        last_id = row["id"]
+                        if is_legacy_blob(row["embedding"]):
+                            rows.append((np_to_blob(blob_to_np(row["embedding"]), dtype), row["id"]))
+
+                    self.cur.executemany(f"update {table} set embedding = ? where id = ?", rows)
+                converted += len(rows)
+
+            logger.info(f"Converted {converted} embeddings in {table}")
+
     def create_database(self, path: str) -> None:
         """
         Create database at location.
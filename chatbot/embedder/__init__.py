@@ -0,0 +1 @@
+from chatbot.embedder.embedder_base import EmbedderBase
@@ -0,0 +1,30 @@
+class EmbedderBase:
+    def __init__(self):
+        pass
+
+    def init_embedder(self) -> None:
+        """
+        Load the embedding model.
+        """
+        raise NotImplementedError()
+
+    def encode(self, sentences, batch_size: int = 32):
+        """
+        Embed a text or a list of texts.
+        :param sentences: text or list of texts
+        :param batch_size: texts per forward pass
+        :return: 1d array for a single text, 2d array with one row per text for a list
+        """
+        raise NotImplementedError()
+
+    def get_dimension(self) -> int:
+        """
+        Dimension of the embedding vectors.
+        """
+        raise NotImplementedError()
+
+    def get_embedder_id(self) -> str:
+        """
+        Id that is stored with every embedding. Embedders with different ids produce incompatible vectors.
+        """
+        raise NotImplementedError()
@@ -0,0 +1,134 @@
+import os
+import re
+import json
+import logging
+
+import numpy as np
+import onnxruntime
+from huggingface_hub import hf_hub_download
+from transformers import AutoTokenizer
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+from chatbot.embedder.embedder_base import EmbedderBase
+from chatbot.global_state import GlobalState
+
+logger = logging.getLogger('embedder_onnx')
+
+
+class EmbedderOnnx(EmbedderBase):
+    """
+    Runs a sentence-transformers model with ONNX Runtime on the CPU.
+    The model is exported (and optionally quantized to int8) once into embedder_onnx_path, pooling, normalization
+    and max sequence length are taken from the sentence-transformers config so the vectors match the PyTorch
+    embedder.
+    """
+    def init_embedder(self) -> None:
+        gs = GlobalState()
+        self.name = gs.config["chromadb_embedder"]
+        self.quantize = gs.config["embedder_onnx_quantize"]
+
+        repo = resolve_model_name(self.name)
+        st_config = read_sentence_transformers_config(repo)
+        self.pooling = st_config["pooling"]
+        self.normalize = st_config["normalize"]
+        self.max_seq_length = st_config["max_seq_length"]
+
+        path = os.path.join(gs.config["embedder_onnx_path"], re.sub(r"[^A-Za-z0-9_.-]", "_", self.name))
+        if not os.path.exists(os.path.join(path, "model.onnx")):
+            logger.info(f"Exporting {repo} to ONNX: {path}")
+            model = ORTModelForFeatureExtraction.from_pretrained(repo, export=True)
+            model.save_pretrained(path)
+            AutoTokenizer.from_pretrained(repo).save_pretrained(path)
+
+        file_name = "model.onnx"
+        if self.quantize:
+            file_name = "model_quantized.onnx"
+            if not os.path.exists(os.path.join(path, file_name)):
+                logger.info(f"Quantizing {path} to int8")
+                quantizer = ORTQuantizer.from_pretrained(path, file_name="model.onnx")
+                qconfig = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+                quantizer.quantize(save_dir=path, quantization_config=qconfig)
+
+        session_options = onnxruntime.SessionOptions()
+        if gs.config["embedder_threads"] > 0:
+            session_options.intra_op_num_threads = gs.config["embedder_threads"]
+
+        self.model = ORTModelForFeatureExtraction.from_pretrained(path, file_name=file_name,
+                                                                  provider="CPUExecutionProvider",
+                                                                  session_options=session_options)
+        self.tokenizer = AutoTokenizer.from_pretrained(path)
+        self.dimension = self.model.config.hidden_size
+
+    def encode(self, sentences, batch_size: int = 32):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        result = np.empty((len(sentences), self.dimension), dtype=np.float32)
+        # sort by length like sentence-transformers, so batches need less padding
+        order = np.argsort([-len(s) for s in sentences], kind="stable")
+        for start in range(0, len(sentences), batch_size):
+            batch = order[start:start + batch_size]
+            inputs = self.tokenizer([sentences[i] for i in batch], padding=True, truncation=True,
+                                    max_length=self.max_seq_length, return_tensors="np")
+            hidden = self.model(**inputs).last_hidden_state
+
+            if self.pooling == "cls":
+                pooled = hidden[:, 0]
+            else:
+                mask = inputs["attention_mask"][..., None].astype(np.float32)
+                pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+            if self.normalize:
+                pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            result[batch] = pooled
+
+        if single:
+            return result[0]
+        return result
+
+    def get_dimension(self) -> int:
+        return self.dimension
+
+    def get_embedder_id(self) -> str:
+        if self.quantize:
+            return f"{self.name}#int8"
+        return self.name
+
+
+def resolve_model_name(name: str) -> str:
+    """
+    Short names like all-MiniLM-L6-v2 are resolved to the sentence-transformers organization, like
+    SentenceTransformer does.
+    """
+    if os.path.isdir(name) or "/" in name:
+        return name
+    return "sentence-transformers/" + name
+
+
+def read_sentence_transformers_config(repo: str) -> dict:
+    """
+    Read pooling mode, normalization and max sequence length of a sentence-transformers model.
+    Missing files fall back to mean pooling without normalization and 512 tokens.
+    """
+    def load(file_name: str):
+        try:
+            if os.path.isdir(repo):
+                path = os.path.join(repo, file_name)
+            else:
+                path = hf_hub_download(repo, file_name)
+            with open(path) as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    bert_config = load("sentence_bert_config.json") or {}
+    pooling_config = load("1_Pooling/config.json") or {}
+    modules = load("modules.json") or []
+
+    return {
+        "max_seq_length": bert_config.get("max_seq_length", 512),
+        "pooling": "cls" if pooling_config.get("pooling_mode_cls_token", False) else "mean",
+        "normalize": any(module.get("type", "").endswith("Normalize") for module in modules),
+    }
@@ -0,0 +1,20 @@
+from sentence_transformers import SentenceTransformer
+
+from chatbot.embedder.embedder_base import EmbedderBase
+from chatbot.global_state import GlobalState
+
+
+class EmbedderSentenceTransformers(EmbedderBase):
+    def init_embedder(self) -> None:
+        gs = GlobalState()
+        self.name = gs.config["chromadb_embedder"]
+        self.model = SentenceTransformer(self.name)
+
+    def encode(self, sentences, batch_size: int = 32):
+        return self.model.encode(sentences, batch_size=batch_size)
+
+    def get_dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def get_embedder_id(self) -> str:
+        return self.name
@@ -0,0 +1,159 @@
+import numpy as np
+
+INITIAL_CAPACITY = 1024
+
+
+class EmbeddingIndex:
+    """
+    Resident embedding matrix for one table of one character.
+    Rows are stored as contiguous, L2-normalized float32 vectors so a query is a single matrix-vector product.
+    """
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.size = 0
+        self.ids = np.empty(INITIAL_CAPACITY, dtype=np.int64)
+        self.token_counts = np.empty(INITIAL_CAPACITY, dtype=np.int64)
+        self.matrix = np.empty((INITIAL_CAPACITY, dim), dtype=np.float32)
+
+    def _reserve(self, count: int) -> None:
+        """
+        Grow the buffers (doubling) so that count more rows fit.
+        """
+        capacity = self.matrix.shape[0]
+        if self.size + count <= capacity:
+            return
+        while capacity < self.size + count:
+            capacity *= 2
+
+        ids = np.empty(capacity, dtype=np.int64)
+        token_counts = np.empty(capacity, dtype=np.int64)
+        matrix = np.empty((capacity, self.dim), dtype=np.float32)
+        ids[:self.size] = self.ids[:self.size]
+        token_counts[:self.size] = self.token_counts[:self.size]
+        matrix[:self.size] = self.matrix[:self.size]
+        self.ids = ids
+        self.token_counts = token_counts
+        self.matrix = matrix
+
+    def append(self, ids: [int], token_counts: [int], embeddings) -> None:
+        """
+        Append rows to the index. Ids that are already present are overwritten in place.
+        :param ids: row ids from database
+        :param token_counts: token count of each row
+        :param embeddings: 2d array with one embedding per row
+        """
+        embeddings = normalize_rows(np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1))
+
+        new_ids = []
+        new_token_counts = []
+        new_rows = []
+        for i, id in enumerate(ids):
+            pos = self.position(id)
+            if pos >= 0:
+                self.token_counts[pos] = token_counts[i]
+                self.matrix[pos] = embeddings[i]
+            else:
+                new_ids.append(id)
+                new_token_counts.append(token_counts[i])
+                new_rows.append(i)
+
+        count = len(new_ids)
+        if count == 0:
+            return
+
+        self._reserve(count)
+        self.ids[self.size:self.size + count] = new_ids
+        self.token_counts[self.size:self.size + count] = new_token_counts
+        self.matrix[self.size:self.size + count] = embeddings[new_rows]
+        self.size += count
+
+    def position(self, id: int) -> int:
+        """
+        Get row position of id or -1 if it is not in the index.
+        """
+        pos = np.flatnonzero(self.ids[:self.size] == id)
+        if len(pos) > 0:
+            return int(pos[0])
+        return -1
+
+    def remove(self, id: int) -> None:
+        """
+        Remove a row and keep the buffers contiguous.
+        """
+        pos = self.position(id)
+        if pos < 0:
+            return
+
+        last = self.size - 1
+        self.ids[pos:last] = self.ids[pos + 1:self.size]
+        self.token_counts[pos:last] = self.token_counts[pos + 1:self.size]
+        self.matrix[pos:last] = self.matrix[pos + 1:self.size]
+        self.size = last
+
+    def query(self, embedding, count: int) -> dict:
+        """
+        Get the count nearest rows to embedding.
+        Distances are squared l2 distances between normalized vectors (2 - 2 * cosine similarity).
+        :param embedding: 1d query vector
+        :param count: max number of results
+        :return: dict with ids, distances and token_counts sorted by ascending distance
+        """
+        return self.query_many(np.asarray(embedding).reshape(1, -1), count)[0]
+
+    def query_many(self, embeddings, count: int, candidate_ids: [int] = None, max_id: int = None) -> [dict]:
+        """
+        Score several queries against the index with a single matrix multiply.
+        :param embeddings: 2d array with one query vector per row
+        :param count: max number of results per query
+        :param candidate_ids: only consider these row ids, None for all rows
+        :param max_id: only consider rows with a smaller id, None for all rows
+        :return: one result dict (see query) per query vector
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        results = []
+        for i in range(embeddings.shape[0]):
+            results.append({
+                "ids": [],
+                "distances": [],
+                "token_counts": [],
+            })
+        if self.size == 0 or count <= 0 or len(results) == 0:
+            return results
+
+        rows = np.arange(self.size)
+        matrix = self.matrix[:self.size]
+        if candidate_ids is not None or max_id is not None:
+            mask = np.ones(self.size, dtype=bool)
+            if candidate_ids is not None:
+                mask &= np.isin(self.ids[:self.size], np.asarray(candidate_ids, dtype=np.int64))
+            if max_id is not None:
+                mask &= self.ids[:self.size] < max_id
+            rows = rows[mask]
+            if len(rows) == 0:
+                return results
+            matrix = self.matrix[rows]
+
+        queries = normalize_rows(embeddings)
+        distances = 2 - 2 * (queries @ matrix.T)
+
+        for i, res in enumerate(results):
+            dist = distances[i]
+            if count < len(rows):
+                candidates = np.argpartition(dist, count)[:count]
+            else:
+                candidates = np.arange(len(rows))
+            order = candidates[np.argsort(dist[candidates], kind="stable")]
+
+            res["ids"] = self.ids[rows[order]].tolist()
+            res["distances"] = dist[order].tolist()
+            res["token_counts"] = self.token_counts[rows[order]].tolist()
+        return results
+
+
+def normalize_rows(matrix):
+    """
+    L2-normalize every row of a 2d array. Zero rows are left as they are.
+    """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return np.ascontiguousarray(matrix / norms, dtype=np.float32)
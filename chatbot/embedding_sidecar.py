@@ -0,0 +1,83 @@
+import os
+import struct
+import threading
+
+import numpy as np
+
+SIDECAR_MAGIC = b"ESC1"
+SIDECAR_HEADER = struct.Struct("<4sI8x")
+
+
+class EmbeddingSidecar:
+    """
+    Append-only file with fixed size float32 embedding rows.
+    The database only stores the row offset, reads go through an np.memmap view so hot files are served from the
+    page cache without copying them into python.
+    """
+    def __init__(self, path: str, dim: int = 0):
+        self.path = path
+        self.dim = dim
+        self.lock = threading.Lock()
+        self._view = None
+
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                magic, dim = SIDECAR_HEADER.unpack(f.read(SIDECAR_HEADER.size))
+            if magic != SIDECAR_MAGIC:
+                raise Exception(f"Invalid embedding sidecar: {path}")
+            self.dim = dim
+
+    def row_count(self) -> int:
+        if self.dim == 0 or not os.path.exists(self.path):
+            return 0
+        return (os.path.getsize(self.path) - SIDECAR_HEADER.size) // (self.dim * 4)
+
+    def append(self, embedding) -> int:
+        """
+        Append an embedding to the file.
+        :param embedding: 1d embedding
+        :return: row offset to store in the database
+        """
+        return self.append_many([embedding])[0]
+
+    def append_many(self, embeddings) -> [int]:
+        """
+        Append several embeddings with one write.
+        The rows are written right after the last complete row, a partial row left by an interrupted write is
+        overwritten so the offsets always match the data.
+        :param embeddings: 2d array or list of 1d embeddings
+        :return: row offsets to store in the database
+        """
+        if len(embeddings) == 0:
+            return []
+        data = np.ascontiguousarray(np.row_stack([np.asarray(e).reshape(-1) for e in embeddings]), dtype="<f4")
+        with self.lock:
+            if self.dim == 0:
+                self.dim = data.shape[1]
+            if data.shape[1] != self.dim:
+                raise Exception(f"Embedding dimension {data.shape[1]} doesn't match sidecar dimension {self.dim}")
+
+            if not os.path.exists(self.path):
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                with open(self.path, "wb") as f:
+                    f.write(SIDECAR_HEADER.pack(SIDECAR_MAGIC, self.dim))
+
+            offset = self.row_count()
+            with open(self.path, "r+b") as f:
+                f.seek(SIDECAR_HEADER.size + offset * self.dim * 4)
+                f.write(data.tobytes())
+                f.truncate()
+            return list(range(offset, offset + data.shape[0]))
+
+    def view(self):
+        """
+        Get a read-only memmap of all rows. The view is reused until the file grows.
+        """
+        rows = self.row_count()
+        if rows == 0:
+            return np.empty((0, self.dim), dtype=np.float32)
+
+        if self._view is None or self._view.shape[0] != rows:
+            self._view = np.memmap(self.path, dtype="<f4", mode="r", offset=SIDECAR_HEADER.size,
+                                   shape=(rows, self.dim))
+        return self._view
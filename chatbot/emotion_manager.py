@@ -4,10 +4,14 @@ from collections import deque, Counter
 from statistics import stdev
 from math import exp
 import re
+import time
+import logging
 
 from chatbot.global_state import GlobalState
 from chatbot.query_templates import emotion_template
 
+logger = logging.getLogger('emotion_manager')
+
 emotion_list = [
     "caring",
     "faithful",
@@ -266,14 +270,26 @@ class EmotionManger:
 
     def nsfw_ratio(self, text: str) -> float:
         try:
-            label = self.nsfw_classifier(text)[0]["label"]
-            score = self.nsfw_classifier(text)[0]["score"]
-            if label == "SFW":
-                return 1 - score
-            return score
+            result = self.nsfw_classifier(text)[0]
+            return self.result_to_nsfw_ratio(result)
         except Exception as e:
             return 0.5
 
+    def nsfw_ratios(self, texts: [str]) -> [float]:
+        """
+        Classify a batch of texts. Falls back to one text at a time if the batch fails.
+        """
+        try:
+            results = self.nsfw_classifier(texts, truncation=True, batch_size=self.gs.config["nsfw_batch_size"])
+            return [self.result_to_nsfw_ratio(result) for result in results]
+        except Exception as e:
+            return [self.nsfw_ratio(text) for text in texts]
+
+    def result_to_nsfw_ratio(self, result: dict) -> float:
+        if result["label"] == "SFW":
+            return 1 - result["score"]
+        return result["score"]
+
     def get_emotions_old(self, text: str) -> list:
         # [{'label': 'anger', 'score': 0.9796756505966187}, {'label': 'sadness', 'score': 0.010976619087159634}, {'label': 'joy', 'score': 0.0030405886936932802}, {'label': 'love', 'score': 0.002827202435582876}, {'label': 'fear', 'score': 0.0018505036132410169}, {'label': 'surprise', 'score': 0.0016293766675516963}]
         output = self.emotion_classifier(
@@ -283,55 +299,130 @@ class EmotionManger:
         )[0]
         return sorted(output, key=lambda x: x["score"], reverse=True)
 
+    def classify_emotions(self, messages: [str]) -> [[float]]:
+        """
+        Run the emotion classifier on a batch of messages.
+        :param messages: texts
+        :return: one list of scores per message, in the order of emotion_list, None for missing labels
+        """
+        output = self.emotion_classifier(
+            messages,
+            truncation=False,
+            max_length=self.emotion_classifier.model.config.max_position_embeddings,
+            batch_size=self.gs.config["emotion_batch_size"],
+        )
+
+        result = []
+        for scores in output:
+            label_map = {}
+            for d in scores:
+                label_map[d["label"]] = d["score"]
+            # Labels the classifier didn't return stay null, like before batching
+            result.append([label_map.get(emotion) for emotion in emotion_list])
+        return result
+
+    def write_emotions(self, ids: [int], scores: [[float]]) -> None:
+        """
+        Write the scores of several messages with one executemany.
+        """
+        columns = ", ".join(f"{emotion} = ?" for emotion in emotion_list)
+        sql = f"update messages set {columns} where id = ?"
+        self.cur.executemany(sql, [score + [id] for id, score in zip(ids, scores)])
+
     def calc_emotions(self, id):
         """
         Recalc emotions of all messages.
         :return:
         """
         if id is None:
-            res = self.cur.execute("SELECT * FROM messages")
-        else:
-            res = self.cur.execute(f"SELECT * FROM messages where id = {id}")
-        res = res.fetchall()
-
-        for i in range(len(res)):
-            id = res[i]["id"]
-            character_id = res[i]["character_id"]
-            is_user = res[i]["is_user"]
-            message = res[i]["message"]
-            character = res[i]["character"]
-            token_count = res[i]["token_count"]
+            self.recalc_emotions()
+            return
 
-            output = self.emotion_classifier(
-                message,
-                truncation=False,
-                max_length=self.emotion_classifier.model.config.max_position_embeddings,
-            )[0]
-            for d in output:
-                lbl = d["label"]
-                sql = f"update messages set {lbl} = ? where id = ?"
-                self.cur.execute(sql, (d["score"], id))
+        res = self.cur.execute("SELECT id, message FROM messages where id = ?", (id,))
+        res = res.fetchall()
+        if len(res) == 0:
+            return
 
-        self.con.commit()
+        scores = self.classify_emotions([res[0]["message"]])
+        self.write_emotions([id], scores)
+        self.gs.db_manager.commit()
 
+    def recalc_emotions(self, resume: bool = False):
+        """
+        Recalculate the emotions of all messages in batches.
+        Every batch is written in its own transaction. Messages that are done have their emotion columns set, so
+        an interrupted run can be continued with resume=True. The database is not locked while classifying.
+        :param resume: continue a previous run instead of starting over
+        """
+        db_manager = self.gs.db_manager
+        batch_size = self.gs.config["emotion_batch_size"]
+        first = emotion_list[0]
+
+        if not resume:
+            with db_manager.transaction():
+                columns = ", ".join(f"{emotion} = null" for emotion in emotion_list)
+                self.cur.execute(f"update messages set {columns}")
+
+        with db_manager.lock:
+            total = self.cur.execute(f"select count(*) as cnt from messages where {first} is null").fetchone()["cnt"]
+        done = 0
+        last_id = -1
+        start = time.time()
+        while True:
+            sql = f"select id, message from messages where {first} is null and id > ? order by id asc limit ?"
+            with db_manager.lock:
+                res = self.cur.execute(sql, (last_id, batch_size)).fetchall()
+            if len(res) == 0:
+                break
+
+            ids = [row["id"] for row in res]
+            scores = self.classify_emotions([row["message"] for row in res])
+            with db_manager.transaction():
+                self.write_emotions(ids, scores)
+
+            last_id = ids[-1]
+            done += len(ids)
+            elapsed = max(time.time() - start, 1e-6)
+            logger.info(f"Emotions: {done}/{total} messages, {done / elapsed:.1f} messages/s")
 
     def get_emotion_from_ids(self, is_message, character_id, ids):
+        return self.summarize_emotions(self.get_emotion_query(is_message, character_id, ids))
+
+    def get_emotion_query(self, is_message: bool, character_id: int, ids: [int]) -> str:
+        """
+        Build the prompt that lets the model describe the emotions of messages or graph contexts.
+        Only reads the database, the generation happens in summarize_emotions.
+        """
         res = self.cur.execute("select name from characters where id = ?", (character_id,)).fetchall()
         name = res[0]["name"]
 
         emotion_map = {}
         for emotion in emotion_list:
             emotion_map[emotion] = 0
-        for i, id in enumerate(ids):
-            if is_message:
-                res = self.cur.execute(f"select * from messages where id = ?", (id,)).fetchall()
-            else:
-                res = self.cur.execute(f"select * from summaries where id in (select summary_id from graph_context where id = {id})").fetchall()
-            if len(res) > 0:
+        db_manager = self.gs.db_manager
+        if is_message:
+            rows = {}
+            for row in db_manager.fetch_rows("messages", ids, emotion_list):
+                rows[row["id"]] = row
+            source_rows = [rows.get(id) for id in ids]
+        else:
+            contexts = {}
+            for row in db_manager.fetch_rows("graph_context", ids, ["summary_id"]):
+                contexts[row["id"]] = row["summary_id"]
+            summary_ids = [contexts[id] for id in ids if id in contexts]
+            rows = {}
+            for row in db_manager.fetch_rows("summaries", summary_ids, emotion_list):
+                rows[row["id"]] = row
+            source_rows = [rows.get(contexts.get(id)) for id in ids]
+
+        for i, row in enumerate(source_rows):
+            # Messages that are still waiting for background enrichment have no emotions yet
+            if row is not None and row[emotion_list[0]] is not None:
                 for emotion in emotion_list:
-                    scaled_em = res[0][emotion]
+                    # Labels the classifier didn't return are null
+                    scaled_em = row[emotion] or 0
                     if is_message:
-                        scaled_em = res[0][emotion] * (i / len(ids))
+                        scaled_em = scaled_em * (i / len(ids))
                     emotion_map[emotion] = emotion_map[emotion] + scaled_em
 
         as_text = ""
@@ -341,7 +432,12 @@ class EmotionManger:
         query = emotion_template
         query = query.replace("<emotions>", as_text.strip())
         query = query.replace("<name>", name.strip())
+        return query
 
+    def summarize_emotions(self, query: str) -> str:
+        """
+        Generate the emotion description for a prompt from get_emotion_query.
+        """
         summary = self.gs.model_manager.get_message(query, stop_words=["</s>"])
         summary = re.sub('[^a-zA-Z,.!? ]+', '', summary)
         summary = summary.replace("\n", " ")
@@ -0,0 +1,116 @@
+import logging
+import threading
+from queue import Queue
+
+from chatbot.global_state import GlobalState
+from chatbot.db_manager import ENRICH_EMOTIONS, ENRICH_EMBEDDING, ENRICH_SUMMARY, ENRICH_ALL
+
+logger = logging.getLogger('enrichment_manager')
+
+
+class EnrichmentManager:
+    """
+    Calculates emotions, embeddings and summaries of new messages.
+    With async_enrichment the stages run in background worker threads, otherwise they run directly on insert.
+    Progress is stored per message in messages.enrichment so unfinished messages are resumed after a restart.
+    """
+    def __init__(self):
+        self.gs = GlobalState()
+        self.queue = Queue()
+        self.workers = []
+
+        if self.gs.config["async_enrichment"]:
+            for i in range(self.gs.config["enrichment_workers"]):
+                worker = threading.Thread(target=self.work, name=f"enrichment_{i}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+            self.resume()
+
+    def resume(self) -> None:
+        """
+        Queue all messages that weren't fully enriched.
+        """
+        cur = self.gs.db_manager.con.cursor()
+        res = cur.execute("select id, enrichment from messages where enrichment is null or enrichment != ? "
+                          "order by id asc", (ENRICH_ALL,)).fetchall()
+        for row in res:
+            self.queue.put(row["id"])
+        if len(res) > 0:
+            logger.info(f"Resuming enrichment of {len(res)} messages")
+
+    def submit(self, id: int) -> None:
+        """
+        Enrich a freshly inserted message. Must be called inside the transaction of the insert when running
+        synchronously, so that a failing stage rolls back the message.
+        """
+        if self.gs.config["async_enrichment"]:
+            self.queue.put(id)
+        else:
+            self.enrich(id)
+
+    def wait(self) -> None:
+        """
+        Block until all queued messages are enriched.
+        """
+        self.queue.join()
+
+    def work(self) -> None:
+        while True:
+            id = self.queue.get()
+            try:
+                self.enrich(id)
+            except Exception as e:
+                logger.error(f"Enrichment of message {id} failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    def enrich(self, id: int) -> None:
+        """
+        Run all missing stages of a message. Every stage is its own transaction, so finished stages survive a crash.
+        The summary stage generates with the model, it locks the database only to read its window and to write, so
+        the chat isn't blocked while it runs.
+        """
+        db_manager = self.gs.db_manager
+        stages = [
+            (ENRICH_EMOTIONS, lambda: self.gs.emotion_manager.calc_emotions(id), True),
+            (ENRICH_EMBEDDING, lambda: self.gs.chroma_manager.calc_embeddings_messages(id), True),
+            (ENRICH_SUMMARY, lambda: self.gs.summary_manager.summarize_message(id), False),
+        ]
+
+        for flag, stage, locked in stages:
+            if locked:
+                with db_manager.transaction():
+                    done = self.run_stage(id, flag, stage)
+            else:
+                done = self.run_stage(id, flag, stage)
+            if not done:
+                return
+
+    def run_stage(self, id: int, flag: int, stage) -> bool:
+        """
+        Run a stage unless its flag is already set, then set the flag.
+        :return: False if the message was deleted
+        """
+        state = self.get_state(id)
+        if state is None:
+            return False
+        if state & flag:
+            return True
+
+        stage()
+        with self.gs.db_manager.transaction():
+            state = self.get_state(id)
+            if state is None:
+                return False
+            self.gs.db_manager.con.execute("update messages set enrichment = ? where id = ?", (state | flag, id))
+        return True
+
+    def get_state(self, id: int):
+        """
+        :return: enrichment flags of a message, None if it was deleted
+        """
+        with self.gs.db_manager.lock:
+            res = self.gs.db_manager.con.execute("select enrichment from messages where id = ?", (id,)).fetchall()
+        if len(res) == 0:
+            return None
+        return res[0]["enrichment"] or 0
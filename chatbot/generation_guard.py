@@ -0,0 +1,72 @@
+import re
+
+from chatbot.utils import split_into_sentences
+from chatbot.phrase_matcher import PhraseMatcher
+from chatbot.repetition_index import RepetitionIndex
+
+SENTENCE_END = re.compile(r"[.!?]")
+
+
+class GenerationGuard:
+    """
+    Incremental version of the banned phrase and similarity checks of a response while it is generated.
+    Text is fed chunk by chunk. Banned phrases are searched in the new tail, every sentence is checked against the
+    repetition index once it is complete (the next sentence started). As soon as the response can't pass the
+    checks anymore it is doomed and the backend can stop generating it.
+    """
+    def __init__(self, banned_phrases: PhraseMatcher, repetition_index: RepetitionIndex = None,
+                 max_similarity: float = 1.0):
+        """
+        :param banned_phrases: compiled banned phrases
+        :param repetition_index: newest messages of the character, None to skip the similarity check
+        :param max_similarity: max jaro similarity of a sentence to an old sentence
+        """
+        self.banned_phrases = banned_phrases
+        self.repetition_index = repetition_index
+        self.max_similarity = max_similarity
+
+        self.text = ""
+        self.checked_sentences = 0
+        self.sentence_pending = False
+        self.doomed = False
+
+    def copy(self) -> "GenerationGuard":
+        """
+        Guard with the same checks and empty state, for another sequence.
+        """
+        return GenerationGuard(self.banned_phrases, self.repetition_index, self.max_similarity)
+
+    def feed(self, new_text: str) -> bool:
+        """
+        Add generated text.
+        :param new_text: text generated since the last call
+        :return: True if the response is doomed
+        """
+        if self.doomed or new_text == "":
+            return self.doomed
+
+        previous_length = len(self.text)
+        self.text += new_text
+
+        if self.banned_phrases.search_partial(self.text, previous_length) is not None:
+            self.doomed = True
+            return True
+
+        if self.repetition_index is None:
+            return False
+
+        if SENTENCE_END.search(new_text):
+            self.sentence_pending = True
+        if self.sentence_pending:
+            # The last sentence may still grow
+            complete = split_into_sentences(self.text)[:-1]
+            if len(complete) > self.checked_sentences:
+                for sentence in complete[self.checked_sentences:]:
+                    if self.repetition_index.max_similarity(sentence, threshold=self.max_similarity) > \
+                            self.max_similarity:
+                        self.doomed = True
+                        return True
+                self.checked_sentences = len(complete)
+                self.sentence_pending = False
+
+        return False
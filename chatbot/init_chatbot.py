@@ -14,10 +14,15 @@ from chatbot.emotion_manager import EmotionManger
 from chatbot.db_manager import DbManager
 from chatbot.summary_manager import SummaryManager
 from chatbot.concept_manager import ConceptManager
+from chatbot.enrichment_manager import EnrichmentManager
 
 logger = logging.getLogger('init_chatbot')
 
-def init_chatbot():
+def init_chatbot(backfill: bool = False):
+    """
+    Create all managers.
+    :param backfill: a one-shot backfill runs next, don't start background re-embedding that would compete with it
+    """
     gs = GlobalState()
 
     dbm = DbManager()
@@ -41,6 +46,12 @@ def init_chatbot():
     cm = ConceptManager()
     gs.concept_manager = cm
 
+    enrichment = EnrichmentManager()
+    gs.enrichment_manager = enrichment
+
+    if not backfill:
+        chroma.start_lazy_reembed()
+
     gs.telegram_chat_id = 0
     gs.telegram_message_id = 0
 
@@ -69,3 +80,23 @@ def init_chatbot():
 
     #if gs.config["interface_type"] == "telegram":
     #    run_telegram_bot()
+
+
+def run_backfill(name: str) -> None:
+    """
+    Run a one-shot backfill from the command line (--backfill).
+    :param name: one of BACKFILLS in config/arguments.py
+    """
+    gs = GlobalState()
+
+    logger.info(f"Running backfill {name}...")
+    if name == "nsfw":
+        gs.message_manager.generate_missing_nsfw_ratio()
+    elif name == "emotions":
+        gs.emotion_manager.recalc_emotions(resume=True)
+    elif name == "embeddings":
+        gs.chroma_manager.calc_embeddings_messages(id=None)
+        gs.chroma_manager.calc_embeddings_summaries(id=None)
+    elif name == "embedding_format":
+        gs.db_manager.migrate_embedding_format()
+    logger.info(f"Backfill {name} done")
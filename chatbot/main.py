@@ -5,7 +5,7 @@ from chatbot.config import validate_arguments
 from chatbot.logger import setup_logging_default, setup_logging_config
 from chatbot.global_state import GlobalState
 from chatbot.webui import start_webui
-from chatbot.init_chatbot import init_chatbot
+from chatbot.init_chatbot import init_chatbot, run_backfill
 from chatbot.telegram.telegram_bot import run_telegram_bot
 
 logger = logging.getLogger('chatbot')
@@ -30,7 +30,11 @@ def main(args: List[str]) -> None:
     gs.top_p_modifier = 0
     gs.regenerate_counter = 0
 
-    init_chatbot()
+    init_chatbot(backfill=args.backfill is not None)
+
+    if args.backfill is not None:
+        run_backfill(args.backfill)
+        return
 
     if config["interface_type"] == "telegram":
         run_telegram_bot()
@@ -11,14 +11,21 @@ import numpy as np
 
 from chatbot.global_state import GlobalState
 from chatbot.exceptions import *
-from chatbot.utils import split_into_sentences, clamp
+from chatbot.utils import clamp
 from chatbot.db_manager import DbManager
+from chatbot.prompt_window import PromptWindow
+from chatbot.repetition_index import RepetitionIndex
+from chatbot.phrase_matcher import PhraseMatcher
+from chatbot.generation_guard import GenerationGuard
 
 logger = logging.getLogger('message_manager')
 
 str_input = "\n\n### Input:\n"
 str_response = "\n\n### Response:\n"
 
+# Number of newest messages of a character a response must not repeat
+REPETITION_HISTORY = 10
+
 class MessageManager():
     def __init__(self):
         self.gs = GlobalState()
@@ -28,6 +35,11 @@ class MessageManager():
         self.current_character_id = 0
         self.current_character_name = ""
 
+        self.prompt_windows = {}
+        self.repetition_indices = {}
+        self.banned_phrases = PhraseMatcher(self.gs.config["banned_phrases"],
+                                            self.gs.config["banned_phrases_word_boundaries"])
+
 
     def list_available_characters(self) -> List[str]:
         """
@@ -49,7 +61,7 @@ class MessageManager():
         if len(res) == 0:
             sql = "insert into characters (name) values (?)"
             self.cur.execute(sql, (name,))
-            self.con.commit()
+            self.gs.db_manager.commit()
         else:
             raise CharacterAlreadyExistsException()
 
@@ -62,7 +74,7 @@ class MessageManager():
         if len(res) > 0:
             sql = "delete from characters where name = (?)"
             self.cur.execute(sql, (name,))
-            self.con.commit()
+            self.gs.db_manager.commit()
         else:
             raise CharacterDoesntExistsException()
 
@@ -88,7 +100,7 @@ class MessageManager():
 
         sql = "update characters set card = ?, token_count = ? where id = ?"
         self.cur.execute(sql, (card, token_count, self.current_character_id))
-        self.con.commit()
+        self.gs.db_manager.commit()
 
         return self.current_character_name, token_count
 
@@ -109,15 +121,27 @@ class MessageManager():
         full_message = character + ": " + message
         token_count = self.gs.model_manager.get_token_count(full_message) + 1
         send_date = datetime.now(timezone.utc)
-        self.cur.execute(
-            "INSERT INTO messages (character_id, is_user, character, message, time, token_count, nsfw_ratio) VALUES(?, ?, ?, ?, ?, ?, ?)",
-            (self.current_character_id, is_user, character, message, send_date, token_count, ratio))
-        self.con.commit()
-        id = self.cur.lastrowid
 
-        self.gs.emotion_manager.calc_emotions(id)
-        self.gs.chroma_manager.calc_embeddings_messages(id)
-        self.gs.summary_manager.summarize_message()
+        # One transaction for the message and all derived rows, nothing is kept if a stage fails.
+        # With async_enrichment only the message itself is written here.
+        try:
+            with self.gs.db_manager.transaction():
+                self.cur.execute(
+                    "INSERT INTO messages (character_id, is_user, character, message, time, token_count, nsfw_ratio, enrichment) VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+                    (self.current_character_id, is_user, character, message, send_date, token_count, ratio, 0))
+                id = self.cur.lastrowid
+
+                if self.current_character_id in self.prompt_windows:
+                    self.prompt_windows[self.current_character_id].append(id, token_count, full_message)
+                if self.current_character_id in self.repetition_indices:
+                    self.repetition_indices[self.current_character_id].append(id, message)
+
+                self.gs.enrichment_manager.submit(id)
+        except Exception:
+            self.prompt_windows.pop(self.current_character_id, None)
+            self.repetition_indices.pop(self.current_character_id, None)
+            self.gs.chroma_manager.invalidate_index(character_id=self.current_character_id)
+            raise
 
         return id
 
@@ -129,29 +153,31 @@ class MessageManager():
         Call get_response to regenerate it and return it.
         :return: tuple with chat_id, message_id and new response
         """
-        sql = "select * from summaries where character_id = ? order by id desc limit 1"
-        res = self.cur.execute(sql, (self.current_character_id,)).fetchall()
-        if len(res) > 0:
-            id = res[0]["id"]
-            sql = "delete from summaries where id = ?"
-            self.cur.execute(sql, (id,))
-            self.con.commit()
+        with self.gs.db_manager.transaction():
+            sql = "select * from summaries where character_id = ? order by id desc limit 1"
+            res = self.cur.execute(sql, (self.current_character_id,)).fetchall()
+            if len(res) > 0:
+                id = res[0]["id"]
+                sql = "delete from summaries where id = ?"
+                self.cur.execute(sql, (id,))
 
-            self.gs.chroma_manager.delete(is_message=False, id=id)
+                self.gs.chroma_manager.delete(is_message=False, id=id)
 
-        sql = "select * from messages where character_id = ? and is_user = 0 order by id desc limit 1"
-        res = self.cur.execute(sql, (self.current_character_id,)).fetchall()
-        if len(res) > 0:
-            id = res[0]["id"]
-            telegram_chat_id = res[0]["telegram_chat_id"]
-            telegram_message_id = res[0]["telegram_message_id"]
+            sql = "select * from messages where character_id = ? and is_user = 0 order by id desc limit 1"
+            res = self.cur.execute(sql, (self.current_character_id,)).fetchall()
+            if len(res) > 0:
+                id = res[0]["id"]
+                telegram_chat_id = res[0]["telegram_chat_id"]
+                telegram_message_id = res[0]["telegram_message_id"]
 
-            sql = "delete from messages where id = ?"
-            self.cur.execute(sql, (id,))
-            self.con.commit()
+                sql = "delete from messages where id = ?"
+                self.cur.execute(sql, (id,))
 
-            self.gs.chroma_manager.delete(is_message=True, id=id)
+                self.gs.chroma_manager.delete(is_message=True, id=id)
+                self.prompt_windows.pop(self.current_character_id, None)
+                self.repetition_indices.pop(self.current_character_id, None)
 
+        if len(res) > 0:
             db_id, new_prompt = self.get_response()
             return db_id, telegram_chat_id, telegram_message_id, new_prompt
         else:
@@ -180,27 +206,41 @@ class MessageManager():
                 return False
         return True
 
-    def check_similarity_sentences(self, messages: [str], res) -> bool:
-        """
-        Check jaro distance to other messages from model.
-        :param messages:
-        :param res:
-        :return:
-        """
-        input_sentences = split_into_sentences(res)
-        old_sentences = []
-        for mes in messages:
-            tmp = split_into_sentences(mes)
-            for t in tmp:
-                old_sentences.append(t)
-
-        for inps in input_sentences:
-            for olds in old_sentences:
-                if len(inps) > 5 and len(olds) > 5:
-                    sim = jellyfish.jaro_distance(inps, olds)
-                    if sim > self.gs.config["max_jaro_distance"]:
-                        return False
-        return True
+    def get_repetition_index(self, character_id: int) -> RepetitionIndex:
+        """
+        Get the repetition index of the newest messages of a character, load it on first access.
+        It is kept up to date by insert_message.
+        """
+        index = self.repetition_indices.get(character_id)
+        if index is None:
+            index = RepetitionIndex(REPETITION_HISTORY)
+            res = self.cur.execute("SELECT id, message FROM messages where character_id = ? order by id desc limit ?",
+                                   (character_id, REPETITION_HISTORY)).fetchall()
+            for row in reversed(res):
+                index.append(row["id"], row["message"])
+            self.repetition_indices[character_id] = index
+        return index
+
+    def pick_candidate(self, index: RepetitionIndex, candidates: [str]) -> str:
+        """
+        Filter candidates with the similarity and banned phrase checks and pick the least repetitive one.
+        :param index: repetition index of the newest messages
+        :param candidates: generated responses
+        :return: best candidate or None if all were rejected
+        """
+        best = None
+        best_sim = 0
+        for text in candidates:
+            logger.info("New output: " + text.encode('ascii', 'ignore').decode('ascii'))
+            if not self.check_banned_phrases(text):
+                continue
+            sim = index.max_similarity(text)
+            if sim > self.gs.config["max_jaro_distance"]:
+                continue
+            if best is None or sim < best_sim:
+                best = text
+                best_sim = sim
+        return best
 
     def get_old_messages(self, limit: int) -> [str]:
         """
@@ -224,23 +264,16 @@ class MessageManager():
         :param text:
         :return:
         """
-        bp = self.gs.config["banned_phrases"]
-        if len(bp) == 0:
-            return True
+        return not self.banned_phrases.contains(text)
 
-        for p in bp:
-            if p.lower() in text.lower():
-                return False
-
-        return True
-
-    def get_response(self) -> (int, str):
+    def get_response(self, on_update=None) -> (int, str, str):
         """
         Generate a prompt, send it to model and parse response. Save response in database.
-        :return: tuple of id of new response in database and text
+        :param on_update: called with the text generated so far while streaming, None to generate without streaming
+        :return: tuple of id of new response in database, character name and text
         """
-        old_messages = self.get_old_messages(limit=10)
-
+        with self.gs.db_manager.lock:
+            repetition_index = self.get_repetition_index(self.current_character_id)
         prompt = self.get_prompt()
 
         prompt_path = self.gs.config["prompt_path"]
@@ -273,12 +306,25 @@ class MessageManager():
                         self.gs.top_p_modifier = self.gs.top_p_modifier + \
                                                  (self.gs.config["auto_raise_top_p"] * self.gs.regenerate_counter)
 
+                    # Stop generating a response as soon as pick_candidate would reject it
+                    guard = None
+                    if self.gs.config["early_abort"]:
+                        guard = GenerationGuard(self.banned_phrases, repetition_index,
+                                                self.gs.config["max_jaro_distance"])
+                    elif on_update is not None:
+                        # Streamed responses stop at banned phrases before they are shown
+                        guard = GenerationGuard(self.banned_phrases)
+
+                    candidate_count = self.gs.config["candidate_count"]
                     while True:
-                        text = self.call_model(prompt)
-                        logger.info("New output: " + text.encode('ascii', 'ignore').decode('ascii'))
+                        if candidate_count > 1 and on_update is None:
+                            candidates = self.call_model_candidates(prompt, candidate_count, guard)
+                        else:
+                            candidates = [self.call_model(prompt, on_update, guard)]
                         logger.info(f"Using temp {self.gs.temperature_modifier} and top_p {self.gs.top_p_modifier} mod")
-                        if self.check_similarity_sentences(old_messages, text) and self.check_banned_phrases(text):
-                            text = self.clean_result(text)
+                        best = self.pick_candidate(repetition_index, candidates)
+                        if best is not None:
+                            text = self.clean_result(best)
                             break
                         else:
                             logger.info("Too similar, increasing temperature and top_p!")
@@ -286,7 +332,7 @@ class MessageManager():
                                                            self.gs.config["auto_raise_temperature"]
                             self.gs.top_p_modifier = self.gs.top_p_modifier + self.gs.config["auto_raise_top_p"]
                 else:
-                    text = self.call_model(prompt)
+                    text = self.call_model(prompt, on_update)
 
                 # Clean up and insert into db!
                 if text != "":
@@ -314,17 +360,35 @@ class MessageManager():
         :param telegram_message_id:
         :return:
         """
-        sql = "update messages set telegram_chat_id = ?, telegram_message_id = ? where id = ?"
-        self.cur.execute(sql, (telegram_chat_id, telegram_message_id, db_message_id))
-        self.con.commit()
+        with self.gs.db_manager.transaction():
+            sql = "update messages set telegram_chat_id = ?, telegram_message_id = ? where id = ?"
+            self.cur.execute(sql, (telegram_chat_id, telegram_message_id, db_message_id))
 
     def get_prompt_old(self) -> str:
         """
         Generate current prompt with intro and messages to fit inside context size.
+        The database part is built under the db lock, the emotion descriptions are generated by the model afterwards
+        without holding it, so background enrichment isn't blocked meanwhile.
+        """
+        with self.gs.db_manager.lock:
+            card, context_emotions_query, stm_emotions_query = self.build_prompt()
+
+        context_emotions = self.gs.emotion_manager.summarize_emotions(context_emotions_query)
+        stm_emotions = self.gs.emotion_manager.summarize_emotions(stm_emotions_query)
+
+        card = card.replace("#CONCEPT_EMOTIONS#", context_emotions)
+        card = card.replace("#STM_EMOTIONS#", stm_emotions)
+
+        new_prompt = card
+        return new_prompt
+
+    def build_prompt(self) -> (str, str, str):
+        """
+        Fill the card with everything from the database.
+        :return: tuple of card without emotion descriptions and the queries for the concept and stm emotions
         """
 
-        tokens_input = self.gs.model_manager.get_token_count(str_input)
-        tokens_response = self.gs.model_manager.get_token_count(str_response)
+        tokens_input, tokens_response = self.gs.model_manager.get_token_counts([str_input, str_response])
 
         # Set current tokens to context size
         tokens_current = self.gs.config["context_size"]
@@ -445,11 +509,27 @@ class MessageManager():
         return ""
 
     def id_list_to_block(self, lst):
+        rows = self.gs.db_manager.fetch_rows("messages", lst, ["character", "message"])
         text = ""
-        for id in lst:
-            text = text + self.get_full_message_per_id(id) + "\n"
+        for row in rows:
+            text = text + row["character"] + ": " + row["message"] + "\n"
         return text.strip()
 
+    def get_prompt_window(self, character_id: int) -> PromptWindow:
+        """
+        Get the rolling STM window of a character, create it on first access or when the budget changed.
+        """
+        budget = int(self.gs.config["context_size"] * self.gs.config["context_size_reserved_stm"])
+        window = self.prompt_windows.get(character_id)
+        if window is None or window.budget != budget:
+            # The slack only pays off when the backend reuses the prompt prefix of the previous turn
+            slack = 0
+            if self.gs.config["model"] == "gguf" and self.gs.config["gguf_prompt_cache"] != "off":
+                slack = self.gs.config["stm_trim_slack"]
+            window = PromptWindow(self.cur, character_id, budget, slack)
+            self.prompt_windows[character_id] = window
+        return window
+
     def get_prompt(self) -> str:
         """
         Generate current prompt with intro and messages to fit inside context size.
@@ -467,90 +547,83 @@ class MessageManager():
         token_count = self.gs.model_manager.get_token_count(card)
         tokens_current -= token_count
 
-        res = self.cur.execute("SELECT * FROM messages where character_id = ? order by id asc", (self.current_character_id,))
-        res = res.fetchall()
-
-        mem_ustm = []
-        mem_stm = []
-        mem_ltm = []
-        mem_ltm_temp = []
-
-        token_count_ustm = 0
-        token_count_stm = 0
-        token_count_ltm = 0
-        token_count_concepts = 0
-
         context_size_reserved_concept = int(self.gs.config["context_size"] * self.gs.config["context_size_reserved_concept"])
         context_size_reserved_ltm = int(self.gs.config["context_size"] * self.gs.config["context_size_reserved_ltm"])
-        context_size_reserved_stm = int(self.gs.config["context_size"] * self.gs.config["context_size_reserved_stm"])
-
-        length = len(res)
-        i = length - 1
-        cnt = 0
-        while i >= 0:
-            id = res[i]["id"]
-            is_user = res[i]["is_user"]
-            message = res[i]["message"]
-            character = res[i]["character"]
-            token_count = res[i]["token_count"] + 1
 
-            if token_count_ustm + token_count_stm < context_size_reserved_stm:
-                if cnt < self.gs.config["message_count_ustm"]:
-                    mem_ustm.append(id)
-                    token_count_ustm += token_count
-                else:
-                    mem_stm.append(id)
-                    token_count_stm += token_count
-            else:
-                mem_ltm_temp.append(id)
-
-            i -= 1
-            cnt += 1
-
-        mem_ustm = sorted(mem_ustm)
-        mem_stm = sorted(mem_stm)
-        mem_ltm_temp = sorted(mem_ltm_temp)
+        window = self.get_prompt_window(self.current_character_id)
+        ustm_entries, stm_entries = window.get_memory(self.gs.config["message_count_ustm"])
+        mem_ustm = [entry.id for entry in ustm_entries]
+        mem_stm = [entry.id for entry in stm_entries]
 
         mem_ltm = self.gs.chroma_manager.get_related_messages(
             current_character_id=self.current_character_id,
             mem_ustm=mem_ustm,
-            mem_ltm_temp=mem_ltm_temp,
+            ltm_boundary_id=window.boundary_id(),
             max_token_count=context_size_reserved_ltm
         )
 
         mem_ltm = sorted(mem_ltm)
 
-        context, context_emotions = self.gs.concept_manager.get_current_thoughts(
+        context_ids = self.gs.concept_manager.get_current_thought_ids(
             character_id=self.current_character_id,
             summary_count=self.gs.config["message_count_ustm"],
             max_tokens=context_size_reserved_concept
         )
+        context = self.gs.concept_manager.id_list_to_block(context_ids)
+        context_emotions_query = self.gs.emotion_manager.get_emotion_query(False, self.current_character_id,
+                                                                           context_ids)
 
-        stm_emotions = self.gs.emotion_manager.get_emotion_from_ids(True, self.current_character_id, mem_stm + mem_ustm)
+        stm_emotions_query = self.gs.emotion_manager.get_emotion_query(True, self.current_character_id,
+                                                                       mem_stm + mem_ustm)
 
         ltm = self.id_list_to_block(mem_ltm)
-        stm = self.id_list_to_block(mem_stm)
-        ustm = self.id_list_to_block(mem_ustm)
+        stm = "\n".join(entry.line for entry in stm_entries).strip()
+        ustm = "\n".join(entry.line for entry in ustm_entries).strip()
 
         card = card.replace("#LTM#", ltm)
         card = card.replace("#STM#", stm)
         card = card.replace("#USTM#", ustm)
         card = card.replace("#CONCEPTS#", context)
-        card = card.replace("#CONCEPT_EMOTIONS#", context_emotions)
-        card = card.replace("#STM_EMOTIONS#", stm_emotions)
+        return card, context_emotions_query, stm_emotions_query
 
-        new_prompt = card
-        return new_prompt
-
-    def call_model(self, prompt: str) -> str:
+    def call_model(self, prompt: str, on_update=None, guard: GenerationGuard = None) -> str:
         """
         Append
         :param prompt:
+        :param on_update: called with the text generated so far while streaming, None to generate without streaming
+        :param guard: optional GenerationGuard, generation stops as soon as the response is doomed. Only pass one
+                      if the caller rejects doomed responses, the cut off text is returned as it is
         :return:
         """
         user_name = self.gs.config["user_name"]
-        return self.gs.model_manager.get_message(prompt, stop_words=[f"{user_name}:", "\n"])
+        stop_words = [f"{user_name}:", "\n"]
+        if guard is not None:
+            # The guard keeps the state of one response, every try starts with a fresh one
+            guard = guard.copy()
+        if on_update is None:
+            return self.gs.model_manager.get_message(prompt, stop_words=stop_words, guard=guard)
 
+        text = ""
+        stream = self.gs.model_manager.stream_message(prompt, stop_words=stop_words)
+        try:
+            for chunk in stream:
+                text += chunk
+                # Abort as soon as the response is doomed, the caller rejects it anyway
+                if guard is not None and guard.feed(chunk):
+                    break
+                on_update(text)
+        finally:
+            stream.close()
+        return text.strip()
+
+
+    def call_model_candidates(self, prompt: str, n: int, guard: GenerationGuard = None) -> [str]:
+        """
+        Sample n responses for prompt in one go.
+        :param guard: optional GenerationGuard, every candidate is stopped as soon as it is doomed
+        """
+        user_name = self.gs.config["user_name"]
+        return self.gs.model_manager.get_messages(prompt, stop_words=[f"{user_name}:", "\n"], n=n, guard=guard)
 
     def generate_missing_chroma_entries(self):
         self.gs.chroma_manager.clear(is_message=True)
@@ -655,19 +728,30 @@ class MessageManager():
 
     def generate_missing_nsfw_ratio(self):
         """
-        Go over all messages and find the nsfw ratio and update db.
+        Classify all messages without nsfw ratio in batches and update db.
+        Every batch is written with one executemany in its own transaction.
         :return:
         """
-        sql = "select * from messages"
-        res = self.cur.execute(sql)
-        res = res.fetchall()
-        for r in res:
-            id = r["id"]
-            msg = r["message"]
-            ratio = self.gs.emotion_manager.nsfw_ratio(msg)
-            sql = "update messages set nsfw_ratio = ? where id = ?"
-            self.cur.execute(sql, (ratio, id))
-            self.con.commit()
+        batch_size = self.gs.config["nsfw_batch_size"]
+        with self.gs.db_manager.lock:
+            total = self.cur.execute("select count(*) as cnt from messages where nsfw_ratio is null").fetchone()["cnt"]
+        done = 0
+        last_id = -1
+        while True:
+            sql = "select id, message from messages where nsfw_ratio is null and id > ? order by id asc limit ?"
+            with self.gs.db_manager.lock:
+                res = self.cur.execute(sql, (last_id, batch_size)).fetchall()
+            if len(res) == 0:
+                break
+
+            ratios = self.gs.emotion_manager.nsfw_ratios([r["message"] for r in res])
+            with self.gs.db_manager.transaction():
+                sql = "update messages set nsfw_ratio = ? where id = ?"
+                self.cur.executemany(sql, [(ratio, r["id"]) for ratio, r in zip(ratios, res)])
+
+            last_id = res[-1]["id"]
+            done += len(res)
+            logger.info(f"NSFW ratio: {done}/{total} messages")
 
     def get_all_messages(self):
         lst = []
@@ -0,0 +1,135 @@
+import time
+import random
+import logging
+import threading
+from queue import Queue, Empty
+from contextlib import nullcontext
+from concurrent.futures import Future
+
+import torch
+from transformers import StoppingCriteriaList
+
+from chatbot.model_utils import BatchStoppingCriteria
+from chatbot.utils import cut_stop_strings
+
+logger = logging.getLogger('generation_scheduler')
+
+
+class GenerationRequest:
+    def __init__(self, prompt: str, max_token_length: int, stop_words: [str]):
+        self.prompt = prompt
+        self.max_token_length = max_token_length
+        self.stop_words = stop_words
+        self.future = Future()
+
+
+class GenerationScheduler:
+    """
+    Collects concurrent generation requests and runs them as one batched generate call.
+    A batch is started as soon as a request is waiting. Requests that arrive within batch_wait seconds join it,
+    up to max_batch_size. Requests that arrive while a batch is generating go into the next batch.
+    """
+    def __init__(self, generate_batch, max_batch_size: int, batch_wait: float, lock: threading.Lock = None):
+        """
+        :param generate_batch: function (prompts, max_token_lengths, stop_words) -> list of responses
+        :param max_batch_size: max requests per generate call
+        :param batch_wait: seconds to wait for more requests before a batch starts
+        :param lock: optional lock that is held while a batch is generated (shared with non batched users)
+        """
+        self.generate_batch = generate_batch
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.lock = lock
+        self.queue = Queue()
+
+        self.worker = threading.Thread(target=self.run, name="generation_scheduler", daemon=True)
+        self.worker.start()
+
+    def submit(self, prompt: str, max_token_length: int, stop_words: [str]) -> Future:
+        """
+        Queue a generation request.
+        :return: future with the response text
+        """
+        request = GenerationRequest(prompt, max_token_length, stop_words)
+        self.queue.put(request)
+        return request.future
+
+    def next_batch(self) -> [GenerationRequest]:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def run(self) -> None:
+        while True:
+            batch = self.next_batch()
+            try:
+                with self.lock if self.lock is not None else nullcontext():
+                    responses = self.generate_batch([r.prompt for r in batch],
+                                                    [r.max_token_length for r in batch],
+                                                    [r.stop_words for r in batch])
+                for request, response in zip(batch, responses):
+                    request.future.set_result(response)
+            except Exception as e:
+                logger.error(f"Batch of {len(batch)} requests failed: {e}")
+                for request in batch:
+                    request.future.set_exception(e)
+
+
+def generate_batch(model, tokenizer, device: str, prompts: [str], max_token_lengths: [int],
+                   stop_words: [[str]], **generation_args) -> [str]:
+    """
+    Generate responses for several prompts with one generate call.
+    Prompts are left padded so all sequences continue at the same position. Every sequence has its own stop
+    strings and max token length, generation ends when all of them are done and the outputs are cut at their
+    stop string and length.
+    :param model: hf causal lm
+    :param tokenizer: tokenizer of model
+    :param device: device of model
+    :param prompts: prompts
+    :param max_token_lengths: max new tokens per prompt
+    :param stop_words: stop strings per prompt
+    :param generation_args: sampling arguments for generate
+    :return: responses in the same order
+    """
+    seeds = int(time.time() * 1000)
+    random.seed(seeds)
+    torch.manual_seed(seeds)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(seeds)
+
+    padding_side = tokenizer.padding_side
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    try:
+        tokenized = tokenizer(prompts, return_tensors="pt", padding=True).to(device)
+    finally:
+        tokenizer.padding_side = padding_side
+
+    prompt_length = tokenized.input_ids.shape[1]
+    stopping_criteria_list = StoppingCriteriaList([BatchStoppingCriteria(stop_strings=stop_words,
+                                                                         prompt_length=prompt_length,
+                                                                         tokenizer=tokenizer,
+                                                                         max_token_lengths=max_token_lengths)])
+
+    tokens = model.generate(**tokenized,
+                            max_new_tokens=max(max_token_lengths),
+                            pad_token_id=tokenizer.pad_token_id,
+                            stopping_criteria=stopping_criteria_list,
+                            **generation_args)
+
+    responses = []
+    for i in range(len(prompts)):
+        output = tokenizer.decode(tokens[i][prompt_length:prompt_length + max_token_lengths[i]],
+                                  skip_special_tokens=True)
+        responses.append(cut_stop_strings(output, stop_words[i]).strip())
+    return responses
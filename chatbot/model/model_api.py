@@ -1,4 +1,5 @@
 import time
+import json
 
 import requests
 import subprocess
@@ -9,6 +10,9 @@ from chatbot.model.model_base import ModelBase
 
 logger = logging.getLogger('model_api')
 
+# Requests per call before giving up on a server that keeps failing or returning nothing
+MAX_TRIES = 10
+
 class ModelApi(ModelBase):
     def __init__(self):
         super().__init__()
@@ -16,37 +20,40 @@ class ModelApi(ModelBase):
     def init_model(self):
         return
 
+    def get_payload(self, prompt: str, max_token_length: int, stop_words: [str], n: int = 1) -> dict:
+        return {
+            "n": n,
+            "max_context_length": self.gs.config["context_size"],
+            "max_length": max_token_length,
+            "rep_pen": 1.08,
+            "temperature": 0.7,
+            "top_p": 0.92,
+            "top_k": 100,
+            "top_a": 0,
+            "typical": 1,
+            "tfs": 1,
+            "rep_pen_range": 320,
+            "rep_pen_slope": 0.7,
+            "sampler_order": [
+                6,
+                0,
+                1,
+                2,
+                3,
+                4,
+                5
+            ],
+            "prompt": prompt,
+            "quiet": True,
+            "stop_sequence": stop_words
+        }
+
     def get_response(self, prompt: str, max_token_length: int, stop_words: [str]) -> str:
         self.gs = GlobalState()
 
-        while True:
+        for i in range(MAX_TRIES):
             try:
-                t = {
-                    "n": 1,
-                    "max_context_length": self.gs.config["context_size"],
-                    "max_length": max_token_length,
-                    "rep_pen": 1.08,
-                    "temperature": 0.7,
-                    "top_p": 0.92,
-                    "top_k": 100,
-                    "top_a": 0,
-                    "typical": 1,
-                    "tfs": 1,
-                    "rep_pen_range": 320,
-                    "rep_pen_slope": 0.7,
-                    "sampler_order": [
-                        6,
-                        0,
-                        1,
-                        2,
-                        3,
-                        4,
-                        5
-                    ],
-                    "prompt": prompt,
-                    "quiet": True,
-                    "stop_sequence": stop_words
-                }
+                t = self.get_payload(prompt, max_token_length, stop_words)
                 r = requests.post('http://localhost:5001/api/v1/generate/', json=t)
                 j = r.json()
                 msg = j["results"][0]["text"]
@@ -56,3 +63,49 @@ class ModelApi(ModelBase):
                 return msg
             except Exception as e:
                 logger.error(str(e))
+
+        raise Exception(f"No response from the api after {MAX_TRIES} tries")
+
+    def get_responses(self, prompt: str, max_token_length: int, stop_words: [str], n: int, guard=None) -> [str]:
+        """
+        Request n results at once. Servers that return fewer results are asked again for the rest, up to MAX_TRIES
+        requests. If the server still returned fewer, the collected results are returned.
+        With a guard the results are streamed one after another, so each can be stopped early.
+        """
+        if guard is not None:
+            return super().get_responses(prompt, max_token_length, stop_words, n, guard)
+
+        self.gs = GlobalState()
+
+        results = []
+        for i in range(MAX_TRIES):
+            if len(results) >= n:
+                break
+            try:
+                t = self.get_payload(prompt, max_token_length, stop_words, n - len(results))
+                r = requests.post('http://localhost:5001/api/v1/generate/', json=t)
+                j = r.json()
+                for result in j["results"]:
+                    results.append(result["text"].replace("</s>", "").strip())
+            except Exception as e:
+                logger.error(str(e))
+
+        if len(results) == 0:
+            raise Exception(f"No response from the api after {MAX_TRIES} tries")
+        return results[:n]
+
+    def stream_response(self, prompt: str, max_token_length: int, stop_words: [str]):
+        """
+        Read the generated tokens from the server-sent events of the koboldcpp stream endpoint.
+        """
+        self.gs = GlobalState()
+
+        t = self.get_payload(prompt, max_token_length, stop_words)
+        with requests.post('http://localhost:5001/api/extra/generate/stream', json=t, stream=True) as r:
+            for line in r.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                token = json.loads(line[len("data:"):]).get("token", "")
+                token = token.replace("</s>", "")
+                if token != "":
+                    yield token
@@ -1,3 +1,8 @@
+from typing import Iterator
+
+from chatbot.utils import filter_stop_strings
+
+
 class ModelBase:
     def __init__(self):
         super().__init__()
@@ -10,3 +15,37 @@ class ModelBase:
 
     def get_response(self, prompt: str, max_token_length: int, stop_words: [str]) -> str:
         raise NotImplementedError()
+
+    def get_response_guarded(self, prompt: str, max_token_length: int, stop_words: [str], guard) -> str:
+        """
+        Generate a response and stop as soon as the GenerationGuard dooms it.
+        The default streams the response and closes the stream, which stops the backend at the next token.
+        :return: response, cut off where it was doomed
+        """
+        text = ""
+        stream = self.stream_response(prompt, max_token_length, stop_words)
+        try:
+            for chunk in filter_stop_strings(stream, stop_words):
+                text += chunk
+                if guard.feed(chunk):
+                    break
+        finally:
+            stream.close()
+        return text.strip()
+
+    def get_responses(self, prompt: str, max_token_length: int, stop_words: [str], n: int, guard=None) -> [str]:
+        """
+        Sample n responses for the same prompt.
+        Backends without batched sampling generate them one after another.
+        :param guard: optional GenerationGuard, every response is checked with its own copy
+        """
+        if guard is not None:
+            return [self.get_response_guarded(prompt, max_token_length, stop_words, guard.copy()) for i in range(n)]
+        return [self.get_response(prompt, max_token_length, stop_words) for i in range(n)]
+
+    def stream_response(self, prompt: str, max_token_length: int, stop_words: [str]) -> Iterator[str]:
+        """
+        Generate a response and yield it in chunks while it is generated.
+        Backends without streaming yield the whole response at once.
+        """
+        yield self.get_response(prompt, max_token_length, stop_words)
@@ -12,6 +12,7 @@ from exllamav2 import(
 
 from exllamav2.generator import(
     ExLlamaV2BaseGenerator,
+    ExLlamaV2StreamingGenerator,
     ExLlamaV2Sampler
 )
 
@@ -81,8 +82,9 @@ class ModelExllamaV2(ModelBase):
         input_ids = torch.zeros((1, self.config.max_input_len), dtype = torch.long)
         self.model.forward(input_ids, cache = self.cache, preprocess_only = True)
 
-        # Create generator
+        # Create generators
         self.generator = ExLlamaV2BaseGenerator(self.model, self.cache, self.tokenizer)
+        self.streaming_generator = ExLlamaV2StreamingGenerator(self.model, self.cache, self.tokenizer)
 
     def unload_model(self):
         if self.model:
@@ -95,13 +97,17 @@ class ModelExllamaV2(ModelBase):
         gc.collect()
         torch.cuda.empty_cache()
 
-    def get_response(self, prompt: str, max_token_length: int, stop_words: [str]) -> str:
+    def get_sampler_settings(self) -> ExLlamaV2Sampler.Settings:
         settings = ExLlamaV2Sampler.Settings()
         settings.temperature = 0.85
         settings.top_k = 50
         settings.top_p = 0.95
         settings.token_repetition_penalty = 1.15
         settings.disallow_tokens(self.tokenizer, [self.tokenizer.eos_token_id])
+        return settings
+
+    def get_response(self, prompt: str, max_token_length: int, stop_words: [str]) -> str:
+        settings = self.get_sampler_settings()
 
         ids = self.tokenizer.encode(prompt)
         tokens_prompt = ids.shape[-1]
@@ -123,3 +129,17 @@ class ModelExllamaV2(ModelBase):
         output = output.strip()
 
         return output
+
+    def stream_response(self, prompt: str, max_token_length: int, stop_words: [str]):
+        settings = self.get_sampler_settings()
+
+        ids = self.tokenizer.encode(prompt)
+        self.streaming_generator.set_stop_conditions(["</s>"] + stop_words)
+        self.streaming_generator.begin_stream(ids, settings, token_healing=True)
+
+        for i in range(max_token_length):
+            chunk, eos, _ = self.streaming_generator.stream()
+            if chunk != "":
+                yield chunk
+            if eos:
+                break
@@ -1,13 +1,42 @@
 import copy
 import time
 import gc
+import os
+import hashlib
 import torch
 
-from llama_cpp import Llama, llama_free_model, LogitsProcessor, LogitsProcessorList
+from llama_cpp import Llama, llama_free_model, LogitsProcessor, LogitsProcessorList, LlamaRAMCache, LlamaDiskCache
 
 from chatbot.global_state import GlobalState
 from chatbot.model.model_base import ModelBase
 
+# Prompt caches by model path, they survive reloading the model when switching between characters
+prompt_caches = {}
+
+
+def get_prompt_cache(model_path: str):
+    """
+    Get the llama.cpp state cache of a model. llama.cpp saves the state after every generation and restores the
+    state with the longest common token prefix before evaluating the next prompt, so only the new tail of the
+    prompt has to be evaluated.
+    :param model_path: gguf file
+    :return: cache or None if disabled
+    """
+    gs = GlobalState()
+    mode = gs.config["gguf_prompt_cache"]
+    if mode == "off":
+        return None
+
+    if model_path not in prompt_caches:
+        size = gs.config["gguf_prompt_cache_size"]
+        if mode == "disk":
+            tag = hashlib.sha1(os.path.abspath(model_path).encode("utf-8")).hexdigest()[:12]
+            cache_dir = os.path.join(gs.config["gguf_prompt_cache_path"], tag)
+            prompt_caches[model_path] = LlamaDiskCache(cache_dir=cache_dir, capacity_bytes=size)
+        else:
+            prompt_caches[model_path] = LlamaRAMCache(capacity_bytes=size)
+    return prompt_caches[model_path]
+
 class ModelGguf(ModelBase):
     def __init__(self, model_path: str):
         super().__init__()
@@ -24,16 +53,20 @@ class ModelGguf(ModelBase):
                     n_gpu_layers=self.gs.config["gguf_gpu_layers"],
                     seed=int(time.time()))
 
+        cache = get_prompt_cache(self.model_path)
+        if cache is not None:
+            self.llm.set_cache(cache)
+
     def unload_model(self):
         del self.llm
         self.llm = None
         gc.collect()
         torch.cuda.empty_cache()
 
-    def get_response(self, prompt: str, max_token_length: int, stop_words: [str]) -> str:
-        #self.unload_model()
-        #self.init_model()
-
+    def get_generation_parameters(self) -> dict:
+        """
+        Generation parameters from config with the current temperature and top_p modifiers.
+        """
         args = self.gs.config["gguf_generation_parameters"]
         tmp = copy.copy(args)
 
@@ -41,6 +74,13 @@ class ModelGguf(ModelBase):
             tmp["temperature"] = tmp["temperature"] + self.gs.temperature_modifier
         if "top_p" in tmp:
             tmp["top_p"] = tmp["top_p"] + self.gs.top_p_modifier
+        return tmp
+
+    def get_response(self, prompt: str, max_token_length: int, stop_words: [str]) -> str:
+        #self.unload_model()
+        #self.init_model()
+
+        tmp = self.get_generation_parameters()
 
         output = self.llm(prompt,
                           max_tokens=max_token_length,
@@ -49,3 +89,24 @@ class ModelGguf(ModelBase):
                           **tmp)
         full_out = output["choices"][0]["text"].replace("\\n", "\n")
         return full_out
+
+    def stream_response(self, prompt: str, max_token_length: int, stop_words: [str]):
+        tmp = self.get_generation_parameters()
+
+        pending = ""
+        for output in self.llm(prompt,
+                               max_tokens=max_token_length,
+                               stop=stop_words,
+                               echo=False,
+                               stream=True,
+                               **tmp):
+            text = pending + output["choices"][0]["text"]
+            # An escaped newline can be split over two tokens, keep a trailing backslash until the next one
+            pending = ""
+            if text.endswith("\\"):
+                text, pending = text[:-1], "\\"
+            text = text.replace("\\n", "\n")
+            if text != "":
+                yield text
+        if pending != "":
+            yield pending
@@ -1,6 +1,7 @@
 import random
 import time
 import gc
+import threading
 
 import torch
 from peft import PeftModel
@@ -18,7 +19,8 @@ from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     BitsAndBytesConfig,
-    StoppingCriteriaList
+    StoppingCriteriaList,
+    TextIteratorStreamer
 )
 
 from accelerate import infer_auto_device_map, init_empty_weights
@@ -28,6 +30,8 @@ from datasets import load_dataset
 from chatbot.global_state import GlobalState
 from chatbot.model_utils import StoppingCriteriaSub
 from chatbot.model.model_base import ModelBase
+from chatbot.model.generation_scheduler import generate_batch
+from chatbot.utils import cut_stop_strings
 
 
 class Callbacks(transformers.TrainerCallback):
@@ -162,7 +166,11 @@ class ModelHf(ModelBase):
         gc.collect()
         torch.cuda.empty_cache()
 
-    def get_response(self, prompt: str, max_token_length: int, stop_words: [str]) -> str:
+    def prepare_generation(self, prompt: str, max_token_length: int, stop_words: [str], cancel=None,
+                           guard=None) -> dict:
+        """
+        Seed the rng, tokenize prompt and get the arguments for generate.
+        """
         seeds = int(time.time() * 1000)
         random.seed(seeds)
         torch.manual_seed(seeds)
@@ -173,22 +181,93 @@ class ModelHf(ModelBase):
 
         stopping_criteria_list = StoppingCriteriaList([StoppingCriteriaSub(stop_strings=stop_words,
                                                                            prompt_length=tokenized.input_ids.shape[1],
-                                                                           tokenizer=self.tokenizer)])
-
-        token = self.model.generate(**tokenized,
-                                    max_new_tokens=max_token_length,
-                                    do_sample=True,
-                                    temperature=0.9,
-                                    repetition_penalty=1.1,
-                                    # eos_token_id=[],
-                                    stopping_criteria=stopping_criteria_list,
-                                    early_stopping=True)
-
-        output = self.tokenizer.decode(token[0][tokenized.input_ids.shape[1]:])
+                                                                           tokenizer=self.tokenizer,
+                                                                           cancel=cancel,
+                                                                           guard=guard)])
+
+        return dict(**tokenized,
+                    max_new_tokens=max_token_length,
+                    do_sample=True,
+                    temperature=0.9,
+                    repetition_penalty=1.1,
+                    # eos_token_id=[],
+                    stopping_criteria=stopping_criteria_list,
+                    early_stopping=True)
+
+    def get_response(self, prompt: str, max_token_length: int, stop_words: [str]) -> str:
+        args = self.prepare_generation(prompt, max_token_length, stop_words)
+        prompt_length = args["input_ids"].shape[1]
+
+        token = self.model.generate(**args)
+
+        output = self.tokenizer.decode(token[0][prompt_length:])
         output = output.strip()
 
         return output
 
+    def get_response_guarded(self, prompt: str, max_token_length: int, stop_words: [str], guard) -> str:
+        """
+        The guard runs inside the stopping criteria, generate stops at the token that dooms the response.
+        """
+        return self.get_responses(prompt, max_token_length, stop_words, 1, guard)[0]
+
+    def get_responses(self, prompt: str, max_token_length: int, stop_words: [str], n: int, guard=None) -> [str]:
+        """
+        Sample n responses with one generate call (num_return_sequences).
+        With a guard, doomed sequences count as finished and generation stops when all sequences are finished.
+        """
+        args = self.prepare_generation(prompt, max_token_length, stop_words, guard=guard)
+        prompt_length = args["input_ids"].shape[1]
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+
+        tokens = self.model.generate(**args, num_return_sequences=n, pad_token_id=pad_token_id)
+
+        outputs = []
+        for row in tokens:
+            output = self.tokenizer.decode(row[prompt_length:], skip_special_tokens=True)
+            outputs.append(cut_stop_strings(output, stop_words).strip())
+        return outputs
+
+    def generate_batch(self, prompts: [str], max_token_lengths: [int], stop_words: [[str]]) -> [str]:
+        """
+        Generate responses for several prompts at once, used by the GenerationScheduler.
+        """
+        return generate_batch(self.model, self.tokenizer, self.device, prompts, max_token_lengths, stop_words,
+                              do_sample=True,
+                              temperature=0.9,
+                              repetition_penalty=1.1)
+
+    def stream_response(self, prompt: str, max_token_length: int, stop_words: [str]):
+        """
+        Run generate in one worker thread and yield the decoded text from a TextIteratorStreamer.
+        Closing the generator stops the generation at the next token.
+        """
+        cancel = threading.Event()
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        args = self.prepare_generation(prompt, max_token_length, stop_words, cancel=cancel)
+        errors = []
+
+        def generate():
+            try:
+                self.model.generate(**args, streamer=streamer)
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        thread = threading.Thread(target=generate, name="hf_generate", daemon=True)
+        thread.start()
+        try:
+            for text in streamer:
+                yield text
+        finally:
+            cancel.set()
+            thread.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+
     def lora(self, dataset_path: str, out_path: str) -> None:
         def generate_prompt(data_point):
             if self.gs.config["add_instructions"]:
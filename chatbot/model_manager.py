@@ -1,15 +1,19 @@
 import os
-from typing import Dict, List, Any, Tuple
+from typing import Dict, List, Any, Tuple, Iterator
 import time
 import logging
 import sqlite3
 from datetime import datetime, timezone
 import shutil
+import hashlib
+import threading
+from collections import OrderedDict
 
 from transformers import AutoTokenizer, AutoModelForCausalLM, LlamaTokenizerFast, StoppingCriteriaList
 
 from chatbot.global_state import GlobalState
 from chatbot.exceptions import *
+from chatbot.utils import filter_stop_strings
 
 logger = logging.getLogger('model_manager')
 
@@ -17,6 +21,10 @@ class ModelManager():
     def __init__(self):
         self.tokenizer = None
         self.model = None
+        self.token_count_cache = OrderedDict()
+        self.token_count_lock = threading.Lock()
+        self.generation_lock = threading.Lock()
+        self.scheduler = None
 
         self.telegram_chat_id = 0
         self.telegram_message_id = 0
@@ -42,18 +50,58 @@ class ModelManager():
 
     def get_token_count(self, prompt: str) -> int:
         """Tokenize prompt and get length + 1 (just to be safe)"""
-        inputs = self.tokenizer.encode(
-            prompt,
-            return_tensors="pt"
-        )
-        return inputs.shape[1] + 1
+        return self.get_token_counts([prompt])[0]
+
+    def get_token_counts(self, prompts: [str]) -> [int]:
+        """
+        Get token count + 1 of several prompts.
+        Counts are cached by content hash, all uncached prompts are tokenized with one batch call.
+        :param prompts: list of texts
+        :return: token counts in the same order
+        """
+        keys = [hashlib.sha1(prompt.encode("utf-8")).digest() for prompt in prompts]
+        counts = [None] * len(prompts)
+        missing = []
+
+        with self.token_count_lock:
+            for i, key in enumerate(keys):
+                if key in self.token_count_cache:
+                    self.token_count_cache.move_to_end(key)
+                    counts[i] = self.token_count_cache[key]
+                else:
+                    missing.append(i)
+
+        if len(missing) == 0:
+            return counts
+
+        unique = list(OrderedDict.fromkeys(prompts[i] for i in missing))
+        encoded = self.tokenizer(unique, add_special_tokens=True)["input_ids"]
+        lengths = {}
+        for text, ids in zip(unique, encoded):
+            lengths[text] = len(ids) + 1
+
+        cache_size = self.gs.config["token_count_cache_size"]
+        with self.token_count_lock:
+            for i in missing:
+                counts[i] = lengths[prompts[i]]
+                self.token_count_cache[keys[i]] = counts[i]
+            while len(self.token_count_cache) > cache_size:
+                self.token_count_cache.popitem(last=False)
+
+        return counts
 
     def init_model(self) -> None:
         """Initialize model."""
         model_type = self.gs.config["model"]
         if model_type == "hf":
             from chatbot.model.model_hf import ModelHf
+            from chatbot.model.generation_scheduler import GenerationScheduler
             self.model = ModelHf()
+            if self.gs.config["hf_batching"]:
+                self.scheduler = GenerationScheduler(self.model.generate_batch,
+                                                     max_batch_size=self.gs.config["hf_max_batch_size"],
+                                                     batch_wait=self.gs.config["hf_batch_wait"],
+                                                     lock=self.generation_lock)
         elif model_type == "api":
             from chatbot.model.model_api import ModelApi
             self.model = ModelApi()
@@ -92,13 +140,57 @@ class ModelManager():
             self.model = ModelGguf(path)
 
 
-    def get_message(self, prompt: str, stop_words: [str]) -> str:
-        result = self.model.get_response(prompt, 256, stop_words)
+    def get_message(self, prompt: str, stop_words: [str], guard=None) -> str:
+        """
+        Generate a message.
+        :param guard: optional GenerationGuard, generation stops as soon as it dooms the message (not with batching)
+        """
+        if self.scheduler is not None:
+            # Concurrent callers are batched, the scheduler holds the generation lock per batch
+            result = self.scheduler.submit(prompt, 256, stop_words).result()
+        else:
+            # Background enrichment (summaries) and the chat share the model, backends aren't thread safe
+            with self.generation_lock:
+                if guard is not None:
+                    result = self.model.get_response_guarded(prompt, 256, stop_words, guard)
+                else:
+                    result = self.model.get_response(prompt, 256, stop_words)
         if self.gs.config["ascii_only"]:
             result = result.encode('ascii', 'ignore').decode('ascii')
 
         return result
 
+    def get_messages(self, prompt: str, stop_words: [str], n: int, guard=None) -> [str]:
+        """
+        Sample n messages for the same prompt with as few generate calls as the backend allows.
+        :param guard: optional GenerationGuard, every message is stopped as soon as it is doomed (not with batching)
+        """
+        if self.scheduler is not None:
+            futures = [self.scheduler.submit(prompt, 256, stop_words) for i in range(n)]
+            results = [future.result() for future in futures]
+        else:
+            with self.generation_lock:
+                results = self.model.get_responses(prompt, 256, stop_words, n, guard=guard)
+        if self.gs.config["ascii_only"]:
+            results = [result.encode('ascii', 'ignore').decode('ascii') for result in results]
+
+        return results
+
+    def stream_message(self, prompt: str, stop_words: [str]) -> Iterator[str]:
+        """
+        Generate a message and yield it in chunks while it is generated. Stop words are cut off the same way for
+        all backends. The model is locked until the generator is exhausted or closed.
+        """
+        with self.generation_lock:
+            stream = self.model.stream_response(prompt, 256, stop_words)
+            try:
+                for chunk in filter_stop_strings(stream, stop_words):
+                    if self.gs.config["ascii_only"]:
+                        chunk = chunk.encode('ascii', 'ignore').decode('ascii')
+                    yield chunk
+            finally:
+                stream.close()
+
     def get_finetuned_model_path(self, character_id: int) -> str:
         """
         get most recent finetuned model from database or empty string
@@ -1,49 +1,142 @@
 import transformers
 import torch
-import asyncio
-import telegram
-import threading
 
-from chatbot.global_state import GlobalState
+# Tokens before the new tokens that are decoded with them, so tokenizers that drop leading spaces of the first
+# token still produce the right text
+DECODE_CONTEXT_TOKENS = 5
 
 
-async def something_async(output, telegram_chat_id, telegram_message_id):
-    gs = GlobalState()
-    bot = telegram.Bot(token=gs.config["telegram"]["api_key"])
-    for user_id in gs.config["telegram"]["user_whitelist"]:
-        try:
-            await bot.editMessageText(
-                chat_id=gs.telegram_chat_id,
-                message_id=gs.telegram_message_id,
-                text=output
-            )
-        except Exception as e:
-            pass
+class SequenceDecodeState:
+    def __init__(self, offset: int, guard=None):
+        self.prefix_offset = offset
+        self.read_offset = offset
+        self.tail = ""
+        self.stopped = False
+        self.guard = guard
+
+
+class StopStringDetector:
+    """
+    Incremental stop string detection for one or more generated sequences.
+    Every step only the tokens since the last step are decoded (plus a few tokens of context) and the stop strings
+    are searched in the new text and a tail buffer of the previous text that is one char shorter than the longest
+    stop string. The cost per step doesn't depend on the length of the output.
+    """
+    def __init__(self, tokenizer, stop_strings: [str], prompt_length: int, guard=None):
+        """
+        :param tokenizer: tokenizer of the model
+        :param stop_strings: list of stop strings
+        :param prompt_length: number of prompt tokens in input_ids
+        :param guard: optional GenerationGuard, every sequence gets a copy and stops when it is doomed
+        """
+        self.tokenizer = tokenizer
+        self.guard = guard
+        self.stop_strings = [stop for stop in stop_strings if stop != ""]
+        self.tail_length = max([len(stop) for stop in self.stop_strings], default=1) - 1
+        self.prompt_length = prompt_length
+        self.states = None
+
+    def decode_new(self, state: SequenceDecodeState, ids: torch.LongTensor) -> str:
+        """
+        Decode the text of the tokens after read_offset. Text that ends in an incomplete utf-8 char is kept back
+        until the next token completes it.
+        """
+        window = ids[state.prefix_offset:].tolist()
+        prefix_text = self.tokenizer.decode(window[:state.read_offset - state.prefix_offset])
+        text = self.tokenizer.decode(window)
+        if len(text) <= len(prefix_text) or text.endswith("\ufffd"):
+            return ""
+
+        state.prefix_offset = state.read_offset
+        state.read_offset = len(ids)
+        return text[len(prefix_text):]
+
+    def update(self, input_ids: torch.LongTensor) -> [bool]:
+        """
+        Process the tokens generated since the last call.
+        :param input_ids: 2d tensor (batch, prompt + generated tokens)
+        :return: per sequence, if a stop string was generated (or the guard doomed it)
+        """
+        if self.states is None:
+            offset = max(0, self.prompt_length - DECODE_CONTEXT_TOKENS)
+            self.states = [SequenceDecodeState(offset, self.guard.copy() if self.guard is not None else None)
+                           for i in range(input_ids.shape[0])]
+            for state in self.states:
+                state.read_offset = self.prompt_length
+
+        for i, state in enumerate(self.states):
+            if state.stopped:
+                continue
+
+            new_text = self.decode_new(state, input_ids[i])
+            if new_text == "":
+                continue
+
+            text = state.tail + new_text
+            for stop in self.stop_strings:
+                if stop in text:
+                    state.stopped = True
+                    break
+            state.tail = text[-self.tail_length:] if self.tail_length > 0 else ""
+
+            if not state.stopped and state.guard is not None and state.guard.feed(new_text):
+                state.stopped = True
+
+        return [state.stopped for state in self.states]
 
 
 class StoppingCriteriaSub(transformers.StoppingCriteria):
-    def __init__(self, stop_strings=None, prompt_length=0, tokenizer=None, telegram_chat_id=0, telegram_message_id=0,
-                 telegram_context=None):
+    def __init__(self, stop_strings=None, prompt_length=0, tokenizer=None, cancel=None, guard=None):
+        """
+        Stop generation when a stop string was generated. With several sequences generation stops when every
+        sequence contains a stop string, the per sequence state is in detector.
+        :param stop_strings: list of stop strings
+        :param prompt_length: number of prompt tokens in input_ids
+        :param tokenizer: tokenizer of the model
+        :param cancel: optional threading.Event, generation stops when it is set (streaming consumer went away)
+        :param guard: optional GenerationGuard, sequences also stop when it dooms them
+        """
         super().__init__()
         if stop_strings is None:
             stop_strings = []
         self.stop_strings = stop_strings
         self.prompt_length = prompt_length
         self.tokenizer = tokenizer
-        self.telegram_chat_id = telegram_chat_id
-        self.telegram_message_id = telegram_message_id
-        self.telegram_context = telegram_context
+        self.cancel = cancel
+        self.detector = StopStringDetector(tokenizer, stop_strings, prompt_length, guard)
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        output = self.tokenizer.decode(input_ids[0][self.prompt_length:])
+        if self.cancel is not None and self.cancel.is_set():
+            return True
 
-        gs = GlobalState()
-        if gs.config["message_streaming"]:
-            thread = threading.Thread(target=asyncio.run, args=(something_async(output, self.telegram_chat_id, self.telegram_message_id),))
-            thread.start()
+        return all(self.detector.update(input_ids))
 
-        for stop in self.stop_strings:
-            if stop in output:
-                return True
 
-        return False
+class BatchStoppingCriteria(transformers.StoppingCriteria):
+    def __init__(self, stop_strings: [[str]], prompt_length: int, tokenizer, max_token_lengths: [int]):
+        """
+        Stopping criteria for a batch of unrelated requests. Every sequence has its own stop strings and max token
+        length, generation stops when every sequence is done (stop string, max length or eos).
+        :param stop_strings: stop strings per sequence
+        :param prompt_length: number of (padded) prompt tokens in input_ids
+        :param tokenizer: tokenizer of the model
+        :param max_token_lengths: max new tokens per sequence
+        """
+        super().__init__()
+        self.prompt_length = prompt_length
+        self.max_token_lengths = max_token_lengths
+        self.eos_token_id = tokenizer.eos_token_id
+        self.detectors = [StopStringDetector(tokenizer, stops, prompt_length) for stops in stop_strings]
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        generated = input_ids.shape[1] - self.prompt_length
+        done = True
+        for i, detector in enumerate(self.detectors):
+            if generated >= self.max_token_lengths[i]:
+                continue
+            # Finished sequences are padded with eos
+            if self.eos_token_id is not None and input_ids[i, -1].item() == self.eos_token_id:
+                continue
+            if not detector.update(input_ids[i:i + 1])[0]:
+                done = False
+        return done
@@ -0,0 +1,87 @@
+import re
+
+
+class PhraseMatcher:
+    """
+    Finds any of a list of phrases in a text with one compiled regex.
+    The phrases are merged into a trie before compiling, so phrases with a common start share their branch and the
+    regex only follows the branches that match, instead of trying every phrase at every position.
+    Matching is case-insensitive. With word_boundaries a phrase only matches as whole words.
+    """
+    def __init__(self, phrases: [str], word_boundaries: bool = False):
+        self.phrases = [p.lower() for p in phrases if p != ""]
+        self.word_boundaries = word_boundaries
+        self.max_length = max([len(p) for p in self.phrases], default=0)
+
+        self.regex = None
+        if len(self.phrases) > 0:
+            pattern = trie_to_regex(build_trie(self.phrases))
+            if word_boundaries:
+                pattern = r"(?<!\w)(?:" + pattern + r")(?!\w)"
+            self.regex = re.compile(pattern, re.IGNORECASE)
+
+    def search(self, text: str, start: int = 0):
+        """
+        Find the first phrase in text.
+        :param text: text to search
+        :param start: only look for phrases starting at or after this position
+        :return: re.Match or None
+        """
+        if self.regex is None:
+            return None
+        return self.regex.search(text, start)
+
+    def contains(self, text: str) -> bool:
+        return self.search(text) is not None
+
+    def search_partial(self, text: str, previous_length: int = 0):
+        """
+        Search a text that is still growing while a response is streamed. Only the part that can contain a phrase
+        that wasn't there at the previous search is scanned. With word boundaries, matches that end at the end of
+        the text aren't reported yet, the next chunk could continue the word.
+        :param text: text generated so far
+        :param previous_length: length of text at the previous search
+        :return: re.Match or None
+        """
+        start = max(0, previous_length - self.max_length)
+        while True:
+            match = self.search(text, start)
+            if match is None or not self.word_boundaries or match.end() < len(text):
+                return match
+            start = match.start() + 1
+
+
+def build_trie(phrases: [str]) -> dict:
+    """
+    Nested dicts per char, the key "" marks the end of a phrase.
+    """
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for c in phrase:
+            node = node.setdefault(c, {})
+        node[""] = {}
+    return trie
+
+
+def trie_to_regex(node: dict) -> str:
+    """
+    Convert a trie into a regex that matches exactly its phrases. Shorter phrases are tried last, so the longest
+    phrase wins at a position.
+    """
+    optional = "" in node
+    branches = []
+    for c in sorted(k for k in node.keys() if k != ""):
+        branches.append(re.escape(c) + trie_to_regex(node[c]))
+
+    if len(branches) == 0:
+        return ""
+    if len(branches) == 1:
+        result = branches[0]
+        grouped = "(?:" + result + ")"
+    else:
+        result = "(?:" + "|".join(branches) + ")"
+        grouped = result
+    if optional:
+        return grouped + "?"
+    return result
@@ -0,0 +1,113 @@
+from collections import deque
+
+WINDOW_PAGE_SIZE = 64
+
+
+class WindowEntry:
+    def __init__(self, id: int, token_count: int, line: str):
+        self.id = id
+        self.token_count = token_count
+        self.line = line
+
+
+class PromptWindow:
+    """
+    Rolling window of the newest messages of a character that fit into the STM budget.
+    The window is loaded once with bounded queries and then kept up to date on insert, so building the USTM and STM
+    sections doesn't depend on the length of the history.
+    """
+    def __init__(self, cur, character_id: int, budget: int, slack: float = 0.0):
+        self.cur = cur
+        self.character_id = character_id
+        self.budget = budget
+        self.slack = slack
+        self.entries = deque()
+        self.load()
+
+    def load(self) -> None:
+        """
+        Page backwards through the history until the budget is used up.
+        """
+        self.entries.clear()
+        tokens = 0
+        last_id = None
+        while tokens < self.budget:
+            if last_id is None:
+                sql = "select id, character, message, token_count from messages where character_id = ? " \
+                      "order by id desc limit ?"
+                res = self.cur.execute(sql, (self.character_id, WINDOW_PAGE_SIZE)).fetchall()
+            else:
+                sql = "select id, character, message, token_count from messages where character_id = ? and id < ? " \
+                      "order by id desc limit ?"
+                res = self.cur.execute(sql, (self.character_id, last_id, WINDOW_PAGE_SIZE)).fetchall()
+            if len(res) == 0:
+                break
+
+            for row in res:
+                if tokens >= self.budget:
+                    break
+                self.entries.appendleft(WindowEntry(row["id"], row["token_count"] + 1,
+                                                    row["character"] + ": " + row["message"]))
+                tokens += row["token_count"] + 1
+                last_id = row["id"]
+
+    def append(self, id: int, token_count: int, line: str) -> None:
+        """
+        Add a new message and drop old messages that can't be part of the STM anymore.
+        When the window is full, the oldest slack fraction of the budget is dropped at once. The start of the window
+        then stays the same for the next turns, so backends with a prompt cache can reuse the evaluated prefix.
+        :param id: message id
+        :param token_count: token count of message from database
+        :param line: rendered line (character: message)
+        """
+        self.entries.append(WindowEntry(id, token_count + 1, line))
+
+        keep = self.keep_count(self.budget)
+        if keep < len(self.entries):
+            keep = self.keep_count(self.budget * (1 - self.slack))
+        while len(self.entries) > keep:
+            self.entries.popleft()
+
+    def keep_count(self, budget: float) -> int:
+        """
+        Number of newest entries that fill budget (the last one may cross it).
+        """
+        tokens = 0
+        keep = 0
+        for entry in reversed(self.entries):
+            if tokens >= budget:
+                break
+            tokens += entry.token_count
+            keep += 1
+        return keep
+
+    def contains(self, id: int) -> bool:
+        for entry in self.entries:
+            if entry.id == id:
+                return True
+        return False
+
+    def get_memory(self, ustm_count: int) -> ([WindowEntry], [WindowEntry]):
+        """
+        Split window into USTM and STM, both sorted by ascending id.
+        :param ustm_count: number of newest messages for USTM
+        :return: ustm entries, stm entries
+        """
+        ustm = []
+        stm = []
+        for i, entry in enumerate(reversed(self.entries)):
+            if i < ustm_count:
+                ustm.append(entry)
+            else:
+                stm.append(entry)
+        ustm.reverse()
+        stm.reverse()
+        return ustm, stm
+
+    def boundary_id(self) -> int:
+        """
+        Id of oldest message in window. All messages of the character with a smaller id are LTM candidates.
+        """
+        if len(self.entries) == 0:
+            return 0
+        return self.entries[0].id
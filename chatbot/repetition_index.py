@@ -0,0 +1,82 @@
+from collections import deque
+
+import jellyfish
+import numpy as np
+
+from chatbot.utils import split_into_sentences
+
+# Sentences up to this length are ignored like in the pairwise check
+MIN_SENTENCE_LENGTH = 5
+# ascii chars get their own bucket in the signatures, everything else shares the last one
+SIGNATURE_SIZE = 129
+
+
+def char_signature(sentence: str) -> np.ndarray:
+    """
+    Char histogram of a sentence. Two sentences can't have more jaro matches than the overlap of their histograms.
+    """
+    codes = np.fromiter((min(ord(c), SIGNATURE_SIZE - 1) for c in sentence), dtype=np.int64, count=len(sentence))
+    return np.bincount(codes, minlength=SIGNATURE_SIZE).astype(np.float32)
+
+
+class RepetitionIndex:
+    """
+    Sentences of the newest messages of a character, split once when a message is added.
+    Every sentence has a char histogram. For a candidate sentence, the upper bound of the jaro similarity to all
+    old sentences ((m / len_a + m / len_b + 1) / 3 with m the histogram overlap) is calculated with one numpy
+    operation, jaro itself only runs for sentences whose bound can beat the current result. The result is exactly
+    the same as comparing all pairs.
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.messages = deque()
+        self.sentences = []
+        self.lengths = np.empty(0, dtype=np.float32)
+        self.signatures = np.empty((0, SIGNATURE_SIZE), dtype=np.float32)
+
+    def append(self, id: int, message: str) -> None:
+        """
+        Add a message and drop the oldest one if the index is full.
+        """
+        sentences = [s for s in split_into_sentences(message) if len(s) > MIN_SENTENCE_LENGTH]
+        self.messages.append((id, sentences))
+        while len(self.messages) > self.limit:
+            self.messages.popleft()
+        self.rebuild()
+
+    def rebuild(self) -> None:
+        self.sentences = [s for id, sentences in self.messages for s in sentences]
+        self.lengths = np.array([len(s) for s in self.sentences], dtype=np.float32)
+        if len(self.sentences) > 0:
+            self.signatures = np.row_stack([char_signature(s) for s in self.sentences])
+        else:
+            self.signatures = np.empty((0, SIGNATURE_SIZE), dtype=np.float32)
+
+    def max_similarity(self, text: str, threshold: float = None) -> float:
+        """
+        Highest jaro similarity of a sentence of text to a sentence of the indexed messages.
+        :param text: candidate text
+        :param threshold: only look for a similarity above threshold and stop at the first one, None to get the
+                          exact max
+        :return: max similarity (with threshold only exact if above it), 0 if there are no comparable sentences
+        """
+        best = 0.0
+        if len(self.sentences) == 0:
+            return best
+
+        for sentence in split_into_sentences(text):
+            if len(sentence) <= MIN_SENTENCE_LENGTH:
+                continue
+
+            matches = np.minimum(self.signatures, char_signature(sentence)).sum(axis=1)
+            bounds = (matches / len(sentence) + matches / self.lengths + 1) / 3
+            # Most promising sentences first, so the bound prunes the rest early
+            for i in np.argsort(-bounds, kind="stable"):
+                if bounds[i] <= best or (threshold is not None and bounds[i] <= threshold):
+                    break
+                sim = jellyfish.jaro_distance(sentence, self.sentences[i])
+                if sim > best:
+                    best = sim
+                    if threshold is not None and best > threshold:
+                        return best
+        return best
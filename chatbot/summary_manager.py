@@ -4,6 +4,7 @@ from datetime import datetime, timezone
 from chatbot.summary import SummaryOpenai, SummaryBart, SummaryModel
 from chatbot.global_state import GlobalState
 from chatbot.emotion_manager import emotion_list
+from chatbot.db_manager import ENRICH_EMOTIONS
 
 EMOTION_SUMMARY_FRACTION = 0.5
 MODE_CALC_ALL = 1
@@ -57,7 +58,7 @@ class SummaryManager:
         send_date = datetime.now(timezone.utc)
         self.cur.execute("INSERT INTO summaries (character_id, summary, time, token_count) VALUES(?, ?, ?, ?)",
                          (current_character_id, summary, send_date, token_count))
-        self.con.commit()
+        self.gs.db_manager.commit()
         inserted_id = self.cur.lastrowid
 
         # insert into chroma
@@ -65,22 +66,130 @@ class SummaryManager:
                                       is_user=False, text=summary, token_count=token_count)
 
         # Insert relation to messages
-        for msg_id in ids:
-            self.cur.execute("INSERT INTO summaries_messages (message_id, summary_id) VALUES(?, ?)",
-                             (msg_id, inserted_id))
-            self.con.commit()
+        self.cur.executemany("INSERT INTO summaries_messages (message_id, summary_id) VALUES(?, ?)",
+                             [(msg_id, inserted_id) for msg_id in ids])
+        self.gs.db_manager.commit()
 
-    def summarize_message(self):
-        self.calc_summaries(MODE_CALC_LATEST, False)
+    def summarize_message(self, id: int) -> None:
+        """
+        Summarize the window of messages that ends at message id. Used by the enrichment pipeline.
+        Only reading the window and writing the summary hold the database lock, the summarizer and the concept
+        extraction run without it so the chat isn't blocked while they generate.
+        :param id: id of the newest message of the window
+        """
+        db_manager = self.gs.db_manager
+        with db_manager.lock:
+            res = self.cur.execute("select character_id from messages where id = ?", (id,)).fetchall()
+            if len(res) == 0 or self.has_summary(id):
+                return
+            char_id = res[0]["character_id"]
+
+            lim = self.gs.config["summarizer_message_count"]
+            res = self.cur.execute("SELECT * from messages where id in (select id from messages where character_id = ? "
+                                   "and id <= ? order by id desc limit ?) order by id asc", (char_id, id, lim))
+            msgs = res.fetchall()
+            block_ids, block_msgs, emotions, emotion_counter = self.get_summary_block(msgs, len(msgs) - 1)
+
+        if len(block_ids) == 0:
+            return
+
+        whole_text = "\n".join(block_msgs)
+        summary = self.summarizer.summarize_text(whole_text)
+        concepts = self.gs.concept_manager.fetch_concepts_from_texts([summary])
+
+        with db_manager.transaction():
+            # Another worker may have summarized the same window meanwhile
+            if self.has_summary(id):
+                return
+            self.insert_summary(char_id, whole_text, summary, block_ids, emotions, emotion_counter, concepts)
+
+    def has_summary(self, last_message_id: int) -> bool:
+        res = self.cur.execute("select id from summaries where last_message_id = ? limit 1", (last_message_id,))
+        return len(res.fetchall()) > 0
 
     def recalc_all_summaries(self):
         self.calc_summaries(MODE_CALC_ALL, True)
 
+    def get_summary_block(self, msgs: list, j: int) -> ([int], [str], dict, int):
+        """
+        Collect the window of messages that ends at msgs[j] and the summary before it.
+        Messages whose emotions aren't calculated yet don't count towards the emotions.
+        :return: tuple of message ids, texts, summed emotions and number of summed rows
+        """
+        cur_block_ids = []
+        cur_block_msgs = []
+        cur_emotions = {}
+
+        emotion_counter = 0
+        for emotion in emotion_list:
+            cur_emotions[emotion] = 0
+
+        for k in range(self.gs.config["summarizer_message_count"]):
+            if j - k >= 0:
+                msg_id = msgs[j - k]["id"]
+                message = msgs[j - k]["character"] + ": " + msgs[j - k]["message"]
+                is_user = msgs[j - k]["is_user"]
+
+                cur_block_ids.insert(0, msg_id)
+                cur_block_msgs.insert(0, message)
+
+                if is_user == 0 and (msgs[j - k]["enrichment"] or 0) & ENRICH_EMOTIONS:
+                    emotion_counter += 1
+                    for emotion in emotion_list:
+                        cur_emotions[emotion] = cur_emotions[emotion] + (msgs[j - k][emotion] or 0)
+
+                if k == self.gs.config["summarizer_message_count"] - 1:
+                    res = self.cur.execute("select * from summaries where last_message_id = ?",
+                                           (msg_id,))
+                    sums = res.fetchall()
+                    if len(sums) > 0:
+                        cur_block_msgs.insert(0, sums[0]["summary"])
+
+                        if sums[0][emotion_list[0]] is not None:
+                            emotion_counter += 1
+                            for emotion in emotion_list:
+                                cur_emotions[emotion] = cur_emotions[emotion] + ((sums[0][emotion] or 0) * EMOTION_SUMMARY_FRACTION)
+            else:
+                break
+
+        return cur_block_ids, cur_block_msgs, cur_emotions, emotion_counter
+
+    def insert_summary(self, char_id: int, whole_text: str, summary: str, block_ids: [int], emotions: dict,
+                       emotion_counter: int, concepts=None) -> int:
+        """
+        Write a summary with its embedding, emotions, message relations and concepts.
+        :param concepts: concepts of the summary if they were already fetched, None to fetch them here
+        :return: id of the summary
+        """
+        token_count = self.gs.model_manager.get_token_count(summary)
+
+        send_date = datetime.now(timezone.utc)
+        self.cur.execute(
+            "INSERT INTO summaries (character_id, original_text, summary, time, token_count, last_message_id) VALUES(?, ?, ?, ?, ?, ?)",
+            (char_id, whole_text, summary, send_date, token_count, block_ids[-1]))
+        self.gs.db_manager.commit()
+        inserted_id = self.cur.lastrowid
+
+        self.gs.chroma_manager.calc_embeddings_summaries(id=inserted_id)
+
+        if emotion_counter > 0:
+            columns = ", ".join(f"{emotion} = ?" for emotion in emotion_list)
+            values = [emotions[emotion] / emotion_counter for emotion in emotion_list]
+            self.cur.execute(f"update summaries set {columns} where id = ?", values + [inserted_id])
+
+        # Insert relation to messages
+        self.cur.executemany("INSERT INTO summaries_messages (message_id, summary_id) VALUES(?, ?)",
+                             [(msg_id, inserted_id) for msg_id in block_ids])
+        self.gs.db_manager.commit()
+
+        self.gs.concept_manager.calc_concepts_summaries(inserted_id, concepts)
+        return inserted_id
+
     def calc_summaries(self, mode: int, clear: bool):
         if clear:
             self.cur.execute("delete from summaries")
             self.cur.execute("delete from summaries_messages")
-            self.con.commit()
+            self.gs.db_manager.commit()
 
         res = self.cur.execute("SELECT * FROM characters")
         chars = res.fetchall()
@@ -106,14 +215,6 @@ class SummaryManager:
                 msgs = res.fetchall()
 
             for j in range(len(msgs)):
-                cur_block_ids = []
-                cur_block_msgs = []
-                cur_emotions = {}
-
-                emotion_counter = 0
-                for emotion in emotion_list:
-                    cur_emotions[emotion] = 0
-
                 if mode == MODE_CALC_ALL:
                     if j < self.gs.config["summarizer_message_count"]:
                         continue
@@ -121,33 +222,7 @@ class SummaryManager:
                     if j != len(msgs) - 1:
                         continue
 
-                for k in range(self.gs.config["summarizer_message_count"]):
-                    if j - k >= 0:
-                        msg_id = msgs[j - k]["id"]
-                        message = msgs[j - k]["character"] + ": " + msgs[j - k]["message"]
-                        is_user = msgs[j - k]["is_user"]
-
-                        cur_block_ids.insert(0, msg_id)
-                        cur_block_msgs.insert(0, message)
-
-                        if is_user == 0:
-                            emotion_counter += 1
-                            for emotion in emotion_list:
-                                cur_emotions[emotion] = cur_emotions[emotion] + msgs[j - k][emotion]
-
-                        if k == self.gs.config["summarizer_message_count"] - 1:
-                            res = self.cur.execute("select * from summaries where last_message_id = ?",
-                                                   (msg_id,))
-                            sums = res.fetchall()
-                            if len(sums) > 0:
-                                cur_block_msgs.insert(0, sums[0]["summary"])
-
-                                emotion_counter += 1
-                                for emotion in emotion_list:
-                                    cur_emotions[emotion] = cur_emotions[emotion] + (sums[0][emotion] * EMOTION_SUMMARY_FRACTION)
-                    else:
-                        break
-
+                cur_block_ids, cur_block_msgs, cur_emotions, emotion_counter = self.get_summary_block(msgs, j)
                 if len(cur_block_ids) == 0:
                     continue
                 if len(cur_block_msgs) == 0:
@@ -157,28 +232,4 @@ class SummaryManager:
                 whole_text.strip()
 
                 summary = self.summarizer.summarize_text(whole_text)
-                token_count = self.gs.model_manager.get_token_count(summary)
-
-                send_date = datetime.now(timezone.utc)
-                self.cur.execute(
-                    "INSERT INTO summaries (character_id, original_text, summary, time, token_count, last_message_id) VALUES(?, ?, ?, ?, ?, ?)",
-                    (char_id, whole_text, summary, send_date, token_count, cur_block_ids[-1]))
-                self.con.commit()
-                inserted_id = self.cur.lastrowid
-
-                self.gs.chroma_manager.calc_embeddings_summaries(id=inserted_id)
-
-                if emotion_counter > 0:
-                    for emotion in emotion_list:
-                        sql = f"update summaries set {emotion} = ? where id = ?"
-                        self.cur.execute(sql, (cur_emotions[emotion] / emotion_counter, inserted_id))
-                self.con.commit()
-
-                # Insert relation to messages
-                for msg_id in cur_block_ids:
-                    self.cur.execute("INSERT INTO summaries_messages (message_id, summary_id) VALUES(?, ?)",
-                                     (msg_id, inserted_id))
-                    self.con.commit()
-
-                self.gs.chroma_manager.calc_embeddings_summaries(inserted_id)
-                self.gs.concept_manager.calc_concepts_summaries(inserted_id)
\ No newline at end of file
+                self.insert_summary(char_id, whole_text, summary, cur_block_ids, cur_emotions, emotion_counter)
@@ -15,6 +15,7 @@ from chatbot.config import configuration
 from chatbot.global_state import GlobalState
 from chatbot.exceptions import *
 from chatbot.constants import *
+from chatbot.utils import Throttle
 
 def check_user(user_id: int) -> bool:
     gs = GlobalState()
@@ -181,6 +182,47 @@ async def sleep_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         else:
             await update.message.reply_text("Please select a character first!")
 
+async def edit_message(bot, chat_id: int, message_id: int, text: str) -> None:
+    try:
+        await bot.editMessageText(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=text
+        )
+    except:
+        pass
+
+async def reply_streaming(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Post a message and edit it while the response is generated.
+    The response is generated in a worker thread, edits are scheduled on the event loop at most every
+    message_streaming_interval seconds and only if the previous edit is done.
+    """
+    gs = GlobalState()
+
+    # Post message that is later edited
+    msg = await update.message.reply_text("Thinking...")
+    chat_id = msg.chat_id
+    message_id = msg.message_id
+
+    loop = asyncio.get_running_loop()
+    throttle = Throttle(gs.config["message_streaming_interval"])
+    pending = []
+
+    def on_update(text: str) -> None:
+        if text.strip() == "" or (len(pending) > 0 and not pending[-1].done()) or not throttle.ready():
+            return
+        pending.append(asyncio.run_coroutine_threadsafe(edit_message(context.bot, chat_id, message_id, text), loop))
+
+    # Get response
+    db_id, name, response = await loop.run_in_executor(None, gs.message_manager.get_response, on_update)
+    gs.message_manager.set_telegram_info(db_id, chat_id, message_id)
+
+    # Final edit
+    if len(pending) > 0:
+        await asyncio.wrap_future(pending[-1])
+    await edit_message(context.bot, chat_id, message_id, response)
+
 async def continue_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Continue the AI response without inputting any data yourself.
@@ -195,32 +237,9 @@ async def continue_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             text = update.message.text
 
             if gs.config["message_streaming"]:
-                # Post message that is later edited
-                msg = await update.message.reply_text("Thinking...")
-                chat_id = msg.chat_id
-                message_id = msg.message_id
-
-                # Set parameters for live chat update
-                gs.telegram_chat_id = chat_id
-                gs.telegram_message_id = message_id
-
-                # Get response
-                db_id, response = gs.message_manager.get_response()
-                gs.message_manager.set_telegram_info(db_id, chat_id, message_id)
-
-                await asyncio.sleep(1)
-
-                # Final edit
-                try:
-                    await context.bot.editMessageText(
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        text=response
-                    )
-                except:
-                    pass
+                await reply_streaming(update, context)
             else:
-                db_id, response = gs.message_manager.get_response()
+                db_id, name, response = gs.message_manager.get_response()
                 msg = await update.message.reply_text(response)
 
                 chat_id = msg.chat_id
@@ -254,30 +273,7 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             gs.message_manager.insert_message(is_user=True, message=text)
 
             if gs.config["message_streaming"]:
-                # Post message that is later edited
-                msg = await update.message.reply_text("Thinking...")
-                chat_id = msg.chat_id
-                message_id = msg.message_id
-
-                # Set parameters for live chat update
-                gs.telegram_chat_id = chat_id
-                gs.telegram_message_id = message_id
-
-                # Get response
-                db_id, response = gs.message_manager.get_response()
-                gs.message_manager.set_telegram_info(db_id, chat_id, message_id)
-
-                await asyncio.sleep(1)
-
-                # Final edit
-                try:
-                    await context.bot.editMessageText(
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        text=response
-                    )
-                except:
-                    pass
+                await reply_streaming(update, context)
             else:
                 db_id, name, response = gs.message_manager.get_response()
                 msg = await update.message.reply_text(response)
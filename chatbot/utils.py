@@ -2,6 +2,8 @@ import re
 import sqlite3
 import numpy as np
 import io
+import struct
+import time
 from numpy.linalg import norm
 
 
@@ -66,20 +68,112 @@ def split_into_sentences(text: str) -> list[str]:
 
 
 
-def np_to_blob(arr):
-    out = io.BytesIO()
-    np.save(out, arr)
-    out.seek(0)
-    return sqlite3.Binary(out.read())
+EMBEDDING_MAGIC = b"EB"
+EMBEDDING_VERSION = 1
+EMBEDDING_HEADER = struct.Struct("<2sBBI")
+EMBEDDING_DTYPES = {
+    1: np.dtype("<f4"),
+    2: np.dtype("<f2"),
+}
+EMBEDDING_DTYPE_CODES = {
+    "float32": 1,
+    "float16": 2,
+}
+
+
+def np_to_blob(arr, dtype: str = "float32"):
+    """
+    Serialize an embedding to the compact blob format.
+    Layout: magic "EB", version byte, dtype byte, uint32 dimension, followed by the raw little-endian values.
+    :param arr: 1d embedding
+    :param dtype: float32 or float16
+    :return: blob for sqlite
+    """
+    code = EMBEDDING_DTYPE_CODES[dtype]
+    data = np.ascontiguousarray(arr, dtype=EMBEDDING_DTYPES[code]).reshape(-1)
+    header = EMBEDDING_HEADER.pack(EMBEDDING_MAGIC, EMBEDDING_VERSION, code, data.shape[0])
+    return sqlite3.Binary(header + data.tobytes())
 
 def blob_to_np(text):
+    """
+    Deserialize an embedding blob. The compact format is decoded zero-copy with np.frombuffer, so the result is
+    read-only. Legacy blobs written with np.save are still supported.
+    """
+    if text[:2] == EMBEDDING_MAGIC:
+        magic, version, code, dim = EMBEDDING_HEADER.unpack_from(text)
+        return np.frombuffer(text, dtype=EMBEDDING_DTYPES[code], count=dim, offset=EMBEDDING_HEADER.size)
+
     out = io.BytesIO(text)
     out.seek(0)
     return np.load(out)
 
+def is_legacy_blob(text) -> bool:
+    """
+    Check if an embedding blob was written with np.save instead of the compact format.
+    """
+    return text is not None and text[:2] != EMBEDDING_MAGIC
+
 def cosine_sim(A, B):
     return np.dot(A, B) / (norm(A) * norm(B))
 
 def l2_squared(A, B):
     dist = np.power(norm(A - B), 2)
     return dist
+
+
+def cut_stop_strings(text: str, stop_strings: [str]) -> str:
+    """
+    Cut text at the first stop string.
+    """
+    for stop in stop_strings:
+        if stop != "" and stop in text:
+            text = text.split(stop)[0]
+    return text
+
+
+def filter_stop_strings(chunks, stop_strings: [str]):
+    """
+    Pass streamed text chunks through until a stop string appears. The stop string and everything after it is
+    dropped. Text that could still be the start of a stop string is held back until it is decided.
+    :param chunks: iterable of text chunks
+    :param stop_strings: list of stop strings
+    :return: generator of text chunks
+    """
+    stop_strings = [stop for stop in stop_strings if stop != ""]
+    holdback = max([len(stop) for stop in stop_strings], default=1) - 1
+    text = ""
+    sent = 0
+    for chunk in chunks:
+        text += chunk
+
+        # Every stop string starting before sent was complete when that text was released, so only search the rest
+        positions = [pos for pos in (text.find(stop, sent) for stop in stop_strings) if pos >= 0]
+        if len(positions) > 0:
+            pos = min(positions)
+            if pos > sent:
+                yield text[sent:pos]
+            return
+
+        end = len(text) - holdback
+        if end > sent:
+            yield text[sent:end]
+            sent = end
+
+    if len(text) > sent:
+        yield text[sent:]
+
+
+class Throttle:
+    """
+    Rate limit for repeated actions like editing a streamed message.
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.last = 0.0
+
+    def ready(self) -> bool:
+        now = time.monotonic()
+        if now - self.last < self.interval:
+            return False
+        self.last = now
+        return True
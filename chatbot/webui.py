@@ -2,6 +2,8 @@ import flet as ft
 
 from chatbot.global_state import GlobalState
 from chatbot.init_chatbot import init_chatbot
+from chatbot.utils import Throttle
+
 class Message():
     def __init__(self, user_name: str, text: str, message_type: str):
         self.user_name = user_name
@@ -12,6 +14,7 @@ class ChatMessage(ft.Row):
     def __init__(self, message: Message):
         super().__init__()
         self.vertical_alignment="start"
+        self.text = ft.Text(message.text, selectable=True)
         self.controls=[
                 ft.CircleAvatar(
                     content=ft.Text(self.get_initials(message.user_name)),
@@ -21,7 +24,7 @@ class ChatMessage(ft.Row):
                 ft.Column(
                     [
                         ft.Text(message.user_name, weight="bold"),
-                        ft.Text(message.text, selectable=True),
+                        self.text,
                     ],
                     tight=True,
                     spacing=5,
@@ -69,7 +72,22 @@ def main(page: ft.Page):
             gs.regenerate_counter = 0
             gs.message_manager.insert_message(is_user=True, message=msg)
 
-            db_id, name, response = gs.message_manager.get_response()
+            if gs.config["message_streaming"]:
+                # Show the response in a local message while it is generated, then replace it for all sessions
+                streamed = ChatMessage(Message(gs.message_manager.current_character_name, "...", "chat_message"))
+                chat.controls.append(streamed)
+                page.update()
+                throttle = Throttle(gs.config["message_streaming_interval"])
+
+                def on_update(text: str):
+                    if throttle.ready():
+                        streamed.text.value = text
+                        page.update()
+
+                db_id, name, response = gs.message_manager.get_response(on_update)
+                chat.controls.remove(streamed)
+            else:
+                db_id, name, response = gs.message_manager.get_response()
             page.pubsub.send_all(Message(name, response, message_type="chat_message"))
             page.update()
 